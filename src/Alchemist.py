@@ -36,7 +36,12 @@ class OptionsDialog(QtGui.QDialog):
                     ('x_speed', 'Print speed (x axis)'),
                     ('y_speed', 'Print speed (y axis)'),
                     ('x_acc', 'Acceleration enabled (x axis)'),
-                    ('y_acc', 'Acceleration enabled (y axis)')
+                    ('y_acc', 'Acceleration enabled (y axis)'),
+                    ('bidirectional', 'Print in both directions'),
+                    ('trim_travel', 'Move straight between lines'),
+                    ('backlash_forward', 'Backlash printing left to right (y axis)'),
+                    ('backlash_reverse', 'Backlash printing right to left (y axis)'),
+                    ('slice_engine', 'Slicing engine (auto, reference, arrays or processes)')
                    ]
     created = {}
 
@@ -91,6 +96,10 @@ class OptionsDialog(QtGui.QDialog):
                 defaultValue = 1500
             elif optionName == "x_acc" or optionName == "y_acc":
                 defaultValue = True
+            elif optionName == "bidirectional" or optionName == "trim_travel":
+                defaultValue = False
+            elif optionName == "slice_engine":
+                defaultValue = "auto"
             else:
                 defaultValue = 0
 
@@ -28,10 +28,9 @@ import hashlib
 import os
 import time
 import sys
-from imageproc import calcDJB2
-
-order = ['8', '4', 'C', '2', 'A', '6', 'E', '1', '9', '5', 'D', '3', 'B'];
-MAX_FIRING_LINE_LEN = 13*4+12
+import instrument
+from djb2 import calcDJB2, blockDJB2, asBytes
+from hexcompress import HexCompressor, compressedPath
 NO_RESPONSE = "Printer didn't respond. Please ensure no other programs have the port open and try again."
 
 class ArgentumPrinterController(PrinterController):
@@ -50,6 +49,19 @@ class ArgentumPrinterController(PrinterController):
     logSerial = False
     serialLog = None
 
+    # Bytes of a file sent before waiting for the printer to check them.
+    BLOCK_SIZE = 1024
+    # Bad blocks before a transfer is given up.
+    MAX_BAD_BLOCKS = 12
+
+    # The most blocks in flight at once, 0 to always stop and wait. Windowed
+    # transfers (see sendWindowed) need firmware that takes them, and no
+    # firmware release is known to yet, so they are only asked for when this
+    # is set. A printer that answers a plain Ready gets stop and wait.
+    WINDOW = 0
+    # Seconds without an answer before a block is sent again.
+    WINDOW_TIMEOUT = 2
+
     def __init__(self, port=None):
         self.port = port
         self.lastCommandTime = None
@@ -87,7 +99,8 @@ class ArgentumPrinterController(PrinterController):
             if self.serialLog == None:
                 self.serialLog = open("serial.log", "wb")
             str = msg
-            for d in data:
+            for d in bytearray(asBytes(data)):
+                d = chr(d)
                 if (d >= 'a' and d <= 'z' or
                     d >= 'A' and d <= 'Z' or
                     d >= '0' and d <= '9' or
@@ -108,7 +121,7 @@ class ArgentumPrinterController(PrinterController):
     def serialSetTimeout(self, timeout, serialDevice=None):
         if serialDevice == None:
             serialDevice = self.serialDevice
-        if sys.platform == "win32":
+        if sys.platform == "win32" and hasattr(serialDevice, 'hComPort'):
             from serial import win32, ctypes
             if timeout == None:
                 timeouts = (0, 0, 0, 0, 0)
@@ -121,6 +134,9 @@ class ArgentumPrinterController(PrinterController):
         else:
             serialDevice.timeout = timeout
 
+    def serialReadText(self, n):
+        return self.serialRead(n).decode('utf-8', 'ignore')
+
     def serialRead(self, n, serialDevice=None):
         data = None
         if serialDevice:
@@ -530,150 +546,88 @@ class ArgentumPrinterController(PrinterController):
         return False
 
     def send(self, path, progressFunc=None, printOnline=False):
+        with instrument.span('send', file=os.path.basename(path),
+                             printOnline=printOnline) as span:
+            result = self.sendFile(path, progressFunc, printOnline, span)
+            span.set(result=result)
+            return result
+
+    def sendFile(self, path, progressFunc, printOnline, span):
         self.sendingFile = True
-        file = open(path, 'r')
-        contents = file.read()
-        file.close()
 
         filename = os.path.basename(path)
 
-        start = time.time()
-
-        size = len(contents)
-        compressed = self.compress(contents)
-        if printOnline:
-            cmd = "recv {} o {}"
+        # Use the slicer's compressed output if there is one, rather than
+        # compressing the whole file again.
+        contents = None
+        compressed = self.loadCompressed(path)
+        if compressed:
+            size = os.path.getsize(path)
         else:
-            cmd = "recv {} {}"
+            file = open(path, 'r')
+            contents = file.read()
+            file.close()
+            size = len(contents)
+            compressed = self.compress(contents)
+        flags = ""
+        span.set(bytes=size)
         if compressed and (printOnline or len(compressed) * 3 < size):
             self.debug("compression rate {} to 1".format(float(size) / len(compressed)))
             size = len(compressed)
+            span.set(compressedBytes=size)
             contents = compressed
-            if printOnline:
-                cmd = "recv {} bo {}"
-            else:
-                cmd = "recv {} b {}"
+            flags = "b"
+        elif contents is None:
+            file = open(path, 'r')
+            contents = file.read()
+            file.close()
+        # Blocks are copied straight out of the file's bytes into the frame.
+        payload = memoryview(asBytes(contents))
+        size = len(payload)
+        if printOnline:
+            flags = flags + "o"
+        windowed = self.windowedTransfers()
+        if windowed:
+            flags = flags + "w"
+        if flags:
+            cmd = "recv {} {} {}".format(size, flags, filename)
+        else:
+            cmd = "recv {} {}".format(size, filename)
         self.serialDevice.flushInput()
         self.serialDevice.flush()
-        response = self.command(cmd.format(size, filename), timeout=10, expect='\n')
+        response = self.command(cmd, timeout=10, expect='\n')
         if response == None:
             self.debug("no response to recv")
             self.sendingFile = False
             return
+        # Firmware that takes windowed transfers says how many blocks it has
+        # room for, or just Ready to stop and wait.
         gotReady = False
+        window = 0
         for line in response:
             if line == "Ready":
                 gotReady = True
+            elif windowed and line.startswith("Ready W "):
+                try:
+                    window = min(int(line[len("Ready W "):]), self.WINDOW, 64)
+                    gotReady = True
+                except ValueError:
+                    pass
         if not gotReady:
             self.debug("Didn't get Ready, got: ")
             self.debug(response)
             self.sendingFile = False
             return
 
-        self.debug("sending {} bytes.".format(size))
-
-        canceled = False
-        paused = False
-
         try:
-            hash = 5381
-            fails = 0
-            pos = 0
-            while (pos < size):
-                if paused:
-                    pres = progressFunc(pos, size)
-                    if pres == False:
-                        self.serialWriteRaw('C')
-                        self.debug("canceled!")
-                        canceled = True
-                        break
-                    if pres == "Pause":
-                        self.serialWriteRaw('P')
-                        self.serialSetTimeout(10)
-                        cmd = self.serialRead(1)
-                        if cmd != 'p':
-                            self.debug("printer didn't ping pause.")
-                            self.serialSetTimeout(1)
-                            rest = cmd + self.serialRead(79)
-                            rest = rest.strip()
-                            if len(rest) > 0:
-                                self.debug("'" + rest + "'")
-                            canceled = True
-                            break
-                        continue
-                nleft = size - pos
-                blocksize = nleft if nleft < 1024 else 1024
-                block = contents[pos:pos+blocksize]
-                encblock = ""
-                oldhash = hash
-                for c in block:
-                    encblock = encblock + c
-                    cval = ord(c)
-                    if cval >= 128:
-                        cval = -(256 - cval)
-                    hash = hash * 33 + cval
-                    hash = hash & 0xffffffff
-                encblock = encblock + chr( hash        & 0x7f)
-                encblock = encblock + chr((hash >>  7) & 0x7f)
-                encblock = encblock + chr((hash >> 14) & 0x7f)
-                encblock = encblock + chr((hash >> 21) & 0x7f)
-                encblock = encblock + chr((hash >> 28) & 0x0f)
-                self.serialWriteRaw(encblock)
-
-                done = False
-                cmd = None
-                while not done and not canceled:
-                    if cmd == None:
-                        self.serialSetTimeout(1)
-                        cmd = self.serialRead(1)
-                        if cmd == "":
-                            cmd = None
-                            continue
-
-                    if cmd == "B":
-                        hash = oldhash
-                        fails = fails + 1
-                        if fails > 12:
-                            self.debug("Too many failures.")
-                            self.serialSetTimeout(0)
-                            self.sendingFile = False
-                            return
-                        self.debug("block is bad at {}/{}".format(pos, size))
-                        done = True
-                        cmd = None
-                    elif cmd == "G":
-                        pos = pos + blocksize
-                        if progressFunc:
-                            pres = progressFunc(pos, size)
-                            if pres == False:
-                                self.serialWriteRaw('C')
-                                self.debug("canceled!")
-                                canceled = True
-                            elif pres == "Pause":
-                                self.debug("paused!")
-                                paused = True
-                        else:
-                            self.debug("block is good at {}/{}".format(pos, size))
-                        done = True
-                        cmd = None
-                    else:
-                        self.serialSetTimeout(1)
-                        rest = cmd + self.serialRead(79)
-                        rest = rest.strip()
-                        if len(rest) > 0:
-                            self.debug("'" + rest + "'")
-                        cmd = None
-                        if len(rest) > 2 and rest[len(rest)-2:] == '\nG':
-                            cmd = 'G'
-                        if rest.find('Errorecv') != -1:
-                            done = True
-                            canceled = True
-
-                if canceled:
-                    break
-
-            if canceled:
-                return False
+            if window:
+                self.debug("sending {} bytes, {} blocks at a time.".format(size, window))
+                result = self.sendWindowed(payload, window, progressFunc, span)
+            else:
+                self.debug("sending {} bytes.".format(size))
+                result = self.sendStopAndWait(payload, progressFunc, span)
+            if result is not True:
+                return result
 
             self.serialSetTimeout(0)
             if progressFunc:
@@ -681,89 +635,250 @@ class ArgentumPrinterController(PrinterController):
             else:
                 self.debug("sent.")
 
-            end = time.time()
-
-            self.debug("Sent in {} seconds.".format(end - start))
+            self.debug("Sent in {} seconds.".format(span.elapsed()))
         finally:
             self.sendingFile = False
 
         return True
 
-    def compress(self, contents):
-        compressed = []
-        lastFiringLine = None
-        lastFiring = None
-        lastParts = []
-        firings = []
-        for line in contents.split('\n'):
-            if len(line) == 0:
+    def windowedTransfers(self):
+        # Whether to ask the printer for a windowed transfer.
+        return self.WINDOW > 0
+
+    def writeBlock(self, frame, payload, n, hash, sequence=None):
+        # Copies block n of payload into frame, after its sequence byte if it
+        # has one, follows it with hash and writes the frame.
+        start = n * self.BLOCK_SIZE
+        blocksize = min(self.BLOCK_SIZE, len(payload) - start)
+        offset = 0
+        if sequence != None:
+            frame[0] = sequence
+            offset = 1
+        end = offset + blocksize
+        frame[offset:end] = payload[start:start+blocksize]
+        frame[end    ] =  hash        & 0x7f
+        frame[end + 1] = (hash >>  7) & 0x7f
+        frame[end + 2] = (hash >> 14) & 0x7f
+        frame[end + 3] = (hash >> 21) & 0x7f
+        frame[end + 4] = (hash >> 28) & 0x0f
+        self.serialWriteRaw(memoryview(frame)[:end + 5])
+        return blocksize
+
+    def transferPaused(self, pos, size, progressFunc):
+        # Asks progressFunc whether a paused transfer should go on. Returns
+        # True to carry on sending, None to stay paused or False if the
+        # transfer is canceled.
+        pres = progressFunc(pos, size)
+        if pres == False:
+            self.serialWriteRaw(b'C')
+            self.debug("canceled!")
+            return False
+        if pres == "Pause":
+            self.serialWriteRaw(b'P')
+            self.serialSetTimeout(10)
+            cmd = self.serialReadText(1)
+            if cmd != 'p':
+                self.debug("printer didn't ping pause.")
+                self.serialSetTimeout(1)
+                rest = cmd + self.serialReadText(79)
+                rest = rest.strip()
+                if len(rest) > 0:
+                    self.debug("'" + rest + "'")
+                return False
+            return None
+        return True
+
+    def transferProgress(self, pos, size, progressFunc):
+        # After a block is good. Returns False if the transfer is canceled
+        # and "Pause" if it should pause.
+        if not progressFunc:
+            self.debug("block is good at {}/{}".format(pos, size))
+            return True
+        pres = progressFunc(pos, size)
+        if pres == False:
+            self.serialWriteRaw(b'C')
+            self.debug("canceled!")
+            return False
+        if pres == "Pause":
+            self.debug("paused!")
+            return "Pause"
+        return True
+
+    def sendStopAndWait(self, payload, progressFunc, span):
+        # Sends a block and waits for the printer to answer G, or B to have
+        # it sent again. The hash after each block is of the whole file up to
+        # the end of the block.
+        size = len(payload)
+        hashes = blockDJB2(payload, self.BLOCK_SIZE)
+        # A block followed by its hash, every block is framed in here.
+        frame = bytearray(self.BLOCK_SIZE + 5)
+
+        canceled = False
+        paused = False
+        fails = 0
+        pos = 0
+        while (pos < size):
+            if paused:
+                result = self.transferPaused(pos, size, progressFunc)
+                if result == False:
+                    return False
+                if result == None:
+                    continue
+            blocksize = self.writeBlock(frame, payload, pos // self.BLOCK_SIZE,
+                                        hashes[pos // self.BLOCK_SIZE])
+
+            done = False
+            cmd = None
+            while not done and not canceled:
+                if cmd == None:
+                    self.serialSetTimeout(1)
+                    cmd = self.serialReadText(1)
+                    if cmd == "":
+                        cmd = None
+                        continue
+
+                if cmd == "B":
+                    fails = fails + 1
+                    span.set(badBlocks=fails)
+                    if fails > self.MAX_BAD_BLOCKS:
+                        self.debug("Too many failures.")
+                        self.serialSetTimeout(0)
+                        return
+                    self.debug("block is bad at {}/{}".format(pos, size))
+                    done = True
+                    cmd = None
+                elif cmd == "G":
+                    pos = pos + blocksize
+                    pres = self.transferProgress(pos, size, progressFunc)
+                    if pres == False:
+                        canceled = True
+                    elif pres == "Pause":
+                        paused = True
+                    done = True
+                    cmd = None
+                else:
+                    self.serialSetTimeout(1)
+                    rest = cmd + self.serialReadText(79)
+                    rest = rest.strip()
+                    if len(rest) > 0:
+                        self.debug("'" + rest + "'")
+                    cmd = None
+                    if len(rest) > 2 and rest[len(rest)-2:] == '\nG':
+                        cmd = 'G'
+                    if rest.find('Errorecv') != -1:
+                        done = True
+                        canceled = True
+
+            if canceled:
+                return False
+
+        return True
+
+    def sendWindowed(self, payload, window, progressFunc, span):
+        # Keeps up to window blocks in flight. Each frame starts with a
+        # sequence byte, the block number modulo 128 with the top bit set so
+        # it can't be mistaken for C or P, and ends with the hash of the block
+        # on its own, so the printer can check blocks in any order. It answers
+        # A when a block is stored and N when it is bad, each followed by the
+        # block's sequence byte. Only bad blocks are sent again, and the oldest
+        # block waiting for an answer if none comes for WINDOW_TIMEOUT.
+        size = len(payload)
+        count = (size + self.BLOCK_SIZE - 1) // self.BLOCK_SIZE
+        hashes = blockDJB2(payload, self.BLOCK_SIZE, chain=False)
+        frame = bytearray(self.BLOCK_SIZE + 6)
+
+        stored = [False] * count
+        # Blocks before first are stored, blocks from next on aren't sent yet.
+        first = 0
+        next = 0
+        fails = 0
+        paused = False
+        while first < count:
+            if paused and first == next:
+                result = self.transferPaused(first * self.BLOCK_SIZE, size, progressFunc)
+                if result == False:
+                    return False
+                if result == None:
+                    continue
+                paused = False
+
+            while not paused and next < count and next < first + window:
+                self.writeBlock(frame, payload, next, hashes[next], 0x80 | (next & 0x7f))
+                next = next + 1
+            if first == next:
                 continue
-            if line[0] == '#':
-                compressed.append(line)
+
+            self.serialSetTimeout(self.WINDOW_TIMEOUT)
+            cmd = self.serialRead(1)
+            if not cmd:
+                self.debug("no answer at {}/{}, sending again.".format(first * self.BLOCK_SIZE, size))
+                self.writeBlock(frame, payload, first, hashes[first], 0x80 | (first & 0x7f))
                 continue
 
-            if line[0] == 'M':
-                if len(firings) > 0:
-
-                    if len(firings) != len(order):
-                        self.debug("firing order changed!")
-                        return None
-                    firingLine = None
-                    for i in range(len(firings)):
-                        if firings[i][0] != order[i]:
-                            self.debug("firing order changed!")
-                            return None
-                        if firingLine:
-                            if firingLine == ".":
-                                firingLine = "," + firings[i][1:]
-                            else:
-                                firingLine = firingLine + "," + firings[i][1:]
-                        else:
-                            firingLine = firings[i][1:]
-                            if firingLine == None or firingLine == "":
-                                firingLine = "."
-                    if lastFiringLine and firingLine == lastFiringLine:
-                        compressed.append('d')
-                    else:
-                        compressed.append(firingLine)
-                    lastFiringLine = firingLine
-                    if len(firingLine) > MAX_FIRING_LINE_LEN:
-                        self.debug("firing line too long.")
-                        return None
-                    firings = []
-                if line[2:3] == 'X':
-                    compressed.append(line[2:3] + line[4:])
-                else:
-                    compressed.append(line[4:])
-            elif line[0] == 'F':
-                firing = line[2:]
-                if lastFiring and firing[1:] == lastFiring[1:]:
-                    firing = firing[0:1]
-                else:
-                    lastFiring = firing
-                    part = None
-                    if firing[1:] == "0000":
-                        firing = firing[0:1] + 'z'
-                    elif firing[1:3] == "00":
-                        part = firing[3:5]
-                        firing = firing[0:1] + 'z'
-                    elif firing[3:5] == "00":
-                        part = firing[1:3]
-                        firing = firing[0:1]
-                    if part:
-                        if part in lastParts:
-                            firing = firing + chr(ord('a') + lastParts.index(part))
-                        else:
-                            lastParts.append(part)
-                            if len(lastParts) > 25:
-                                lastParts.pop(0)
-                            firing = firing + part
-                firings.append(firing)
+            if cmd == b'A' or cmd == b'N':
+                sequence = bytearray(self.serialRead(1))
+                if not sequence:
+                    continue
+                n = first + ((sequence[0] - first) & 0x7f)
+                # A late answer to a block that was sent again.
+                if n >= next or stored[n]:
+                    continue
+
+                if cmd == b'N':
+                    fails = fails + 1
+                    span.set(badBlocks=fails)
+                    if fails > self.MAX_BAD_BLOCKS:
+                        self.debug("Too many failures.")
+                        self.serialSetTimeout(0)
+                        return
+                    self.debug("block is bad at {}/{}".format(n * self.BLOCK_SIZE, size))
+                    self.writeBlock(frame, payload, n, hashes[n], 0x80 | (n & 0x7f))
+                    continue
+
+                stored[n] = True
+                if n != first:
+                    continue
+                while first < count and stored[first]:
+                    first = first + 1
+                pres = self.transferProgress(min(first * self.BLOCK_SIZE, size), size, progressFunc)
+                if pres == False:
+                    return False
+                if pres == "Pause":
+                    paused = True
             else:
-                self.debug("what's this? {}".format(line))
-                return None
+                self.serialSetTimeout(1)
+                rest = cmd.decode('utf-8', 'ignore') + self.serialReadText(79)
+                rest = rest.strip()
+                if len(rest) > 0:
+                    self.debug("'" + rest + "'")
+                if rest.find('Errorecv') != -1:
+                    return False
+
+        return True
 
-        return '\n'.join(compressed) + "\n"
+    def compress(self, contents):
+        with instrument.span('compress', bytes=len(contents)) as span:
+            compressor = HexCompressor(self.debug)
+            for line in contents.split('\n'):
+                if not compressor.line(line):
+                    span.set(compressedBytes=None)
+                    return None
+            compressed = compressor.getvalue()
+            span.set(compressedBytes=len(compressed))
+            return compressed
+
+    def loadCompressed(self, path):
+        # The compressed file written by the slicer along with the hex file,
+        # if there is one and the hex file hasn't been changed since.
+        cpath = compressedPath(path)
+        if not os.path.exists(cpath):
+            return None
+        if os.path.getmtime(cpath) < os.path.getmtime(path):
+            return None
+        file = open(cpath, 'r')
+        compressed = file.read()
+        file.close()
+        return compressed
 
     def volt(self):
         response = self.command("volt", expect='\n', timeout=1)
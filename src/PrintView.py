@@ -27,6 +27,7 @@ import os
 import shutil
 import threading
 import time
+import instrument
 from PyQt4 import QtGui, QtCore, QtSvg
 from gerber import Gerber
 import requests
@@ -527,18 +528,21 @@ class PrintView(QtGui.QWidget):
             return False
         if os.path.getsize(hexFilename) == 0:
             return False
-        hexModified = os.path.getmtime(hexFilename)
-        if time.time() - hexModified > 7*24*60*60:
+        # The hex file is good as long as it was sliced from what the image
+        # and the printer options are now, see processImage.
+        if image.hexKey == None:
             return False
-        last_printer_options_changed = self.argentum.getOption("last_printer_options_changed", None)
-        if last_printer_options_changed != None and hexModified < last_printer_options_changed:
-            return False
-        imgModified = os.path.getmtime(image.filename)
-        if imgModified < hexModified:
-            if image.lastResized:
-                return image.lastResized < hexModified
-            return True
-        return False
+        ip = self.argentum.getImageProcessor()
+        return image.hexKey == ip.getSliceKey(image.pixmap.toImage(),
+                                              self.imageSliceSize(image))
+
+    def imageSliceSize(self, image):
+        # The size to slice a resized image at, None when it isn't resized.
+        if image.lastResized == None:
+            return None
+        width  = image.width  * imageScale[0]
+        height = image.height * imageScale[1]
+        return (int(width), int(height))
 
     def imageProgress(self, y, max_y):
         if self.printCanceled:
@@ -561,13 +565,11 @@ class PrintView(QtGui.QWidget):
         if image.filename.endswith(".hex"):
             return
         ip = self.argentum.getImageProcessor()
+        cache = self.argentum.getSliceCache()
         hexFilename = os.path.join(self.argentum.filesDir, image.hexFilename)
         try:
-            size = None
-            if image.lastResized != None:
-                width  = image.width  * imageScale[0]
-                height = image.height * imageScale[1]
-                size = (int(width), int(height))
+            size = self.imageSliceSize(image)
+            if size != None:
                 print("resizing {} to {},{}.".format(hexFilename, size[0], size[1]))
                 print("original size {},{}.".format(image.pixmap.width(), image.pixmap.height()))
                 image.hexFilename = "{}-{}x{}.hex".format(
@@ -576,9 +578,20 @@ class PrintView(QtGui.QWidget):
                                            image.hexFilename)
                 self.layoutChanged = True
 
-            ip.sliceImage(image.pixmap.toImage(), hexFilename,
-                            progressFunc=self.imageProgress,
-                            size=size)
+            inputImage = image.pixmap.toImage()
+            image.hexKey = None
+            key = ip.getSliceKey(inputImage, size)
+            if cache.fetch(key, hexFilename):
+                print("using the cached slice of {}.".format(image.filename))
+                self.setProgress(incPercent=self.perImage)
+            else:
+                ip.sliceImage(inputImage, hexFilename,
+                                progressFunc=self.imageProgress,
+                                size=size)
+                if self.printCanceled:
+                    return
+                cache.store(key, hexFilename)
+            image.hexKey = key
         except Exception as e:
             print("error processing {}: {}.".format(image.filename, e))
             self.setProgress(labelText="Error processing {}.".format(image.filename))
@@ -713,24 +726,21 @@ class PrintView(QtGui.QWidget):
         try:
             self.setProgress(statusText="Printing.")
 
-            processingStart = time.time()
-
-            self.setProgress(labelText="Processing images...")
-            self.perImage = 20.0 / (len(self.images) - 1)
-            for image in self.images:
-                if image == self.printHeadImage:
-                    continue
-                if not image.visible:
-                    continue
-                if not self.isImageProcessed(image):
-                    self.setProgress(labelText="Processing image {}.".format(os.path.basename(image.filename)))
-                    self.processImage(image)
-                else:
-                    print("Skipping processing of image {}.".format(image.filename))
-                    self.setProgress(incPercent=self.perImage)
-
-            processingEnd = time.time()
-            self.argentum.addTimeSpentProcessingImages(processingEnd - processingStart)
+            with instrument.span('processImages', images=len(self.images) - 1) as processing:
+                self.setProgress(labelText="Processing images...")
+                self.perImage = 20.0 / (len(self.images) - 1)
+                for image in self.images:
+                    if image == self.printHeadImage:
+                        continue
+                    if not image.visible:
+                        continue
+                    if not self.isImageProcessed(image):
+                        self.setProgress(labelText="Processing image {}.".format(os.path.basename(image.filename)))
+                        self.processImage(image)
+                    else:
+                        print("Skipping processing of image {}.".format(image.filename))
+                        self.setProgress(incPercent=self.perImage)
+            self.argentum.addTimeSpentProcessingImages(processing.seconds)
 
             if not self.argentum.printer.connected:
                 self.setProgress(labelText="Printer isn't connected.", statusText="Print aborted. Connect your printer.", canceled=True)
@@ -761,7 +771,6 @@ class PrintView(QtGui.QWidget):
             self.argentum.printer.home(wait=True)
 
             # Now we can actually print!
-            printingStart = time.time()
             for i in range(0, self.printThread.passes):
                 self.setProgress(percent=20, labelText="Starting pass {}".format(i+1))
                 self.perImage = 79.0 / (len(self.images) - 1)
@@ -771,60 +780,54 @@ class PrintView(QtGui.QWidget):
                         continue
                     if not image.visible:
                         continue
-                    while self.progress.paused:
-                        time.sleep(0.5)
-                        if self.printCanceled:
-                            raise PrintCanceledException()
-                    pos = self.printAreaToMove(image.left + image.width, image.bottom)
-                    if image.filename.endswith(".hex"):
-                        pos = (pos[0] - 15 * 80, pos[1] + 560 + 25 * 80)
-                    self.argentum.printer.moveTo(pos[0], pos[1], withOk=True)
-                    response = self.argentum.printer.waitForResponse(timeout=10, expect='Ok')
-                    if response:
-                        response = ''.join(response)
-                        if response.find('/') != -1:
-                            self.setProgress(statusText="Print error - ensure images are within print limits.", canceled=True)
+                    with instrument.span('printImage', printPass=i + 1, image=image.hexFilename) as printing:
+                        while self.progress.paused:
+                            time.sleep(0.5)
+                            if self.printCanceled:
+                                raise PrintCanceledException()
+                        pos = self.printAreaToMove(image.left + image.width, image.bottom)
+                        if image.filename.endswith(".hex"):
+                            pos = (pos[0] - 15 * 80, pos[1] + 560 + 25 * 80)
+                        self.argentum.printer.moveTo(pos[0], pos[1], withOk=True)
+                        response = self.argentum.printer.waitForResponse(timeout=10, expect='Ok')
+                        if response:
+                            response = ''.join(response)
+                            if response.find('/') != -1:
+                                self.setProgress(statusText="Print error - ensure images are within print limits.", canceled=True)
+                                return
+                        self.setProgress(labelText="Pass {}: {}".format(i + 1, image.hexFilename))
+                        path = os.path.join(self.argentum.filesDir, image.hexFilename)
+                        while self.progress.paused:
+                            time.sleep(0.5)
+                            if self.printCanceled:
+                                raise PrintCanceledException()
+                        if not self.argentum.printer.send(path, progressFunc=self.sendProgress, printOnline=True):
+                            self.setProgress(labelText="Printer error.", canceled=True)
                             return
-                    self.setProgress(labelText="Pass {}: {}".format(i + 1, image.hexFilename))
-                    path = os.path.join(self.argentum.filesDir, image.hexFilename)
-                    while self.progress.paused:
-                        time.sleep(0.5)
-                        if self.printCanceled:
-                            raise PrintCanceledException()
-                    if not self.argentum.printer.send(path, progressFunc=self.sendProgress, printOnline=True):
-                        self.setProgress(labelText="Printer error.", canceled=True)
-                        return
-                    nImage = nImage + 1
-                    self.setProgress(percent=(20 + self.perImage * nImage))
-
-                    printingEnd = time.time()
-                    print("printed in {} s".format(printingEnd - printingStart))
-                    self.argentum.addTimeSpentPrinting(printingEnd - printingStart)
-                    printingStart = time.time()
-
-                if self.printThread.useRollers:
-                    self.dryingLoop()
-
-                if self.printThread.alsoPause:
-                    self.setProgress(labelText="Pausing before next pass.")
-                    if not self.progress.paused:
-                        self.progress.pause()
-                    self.argentum.printer.moveTo(100, 100, withOk=True)
-                    self.argentum.printer.waitForResponse(timeout=10, expect='Ok')
-                    while self.progress.paused:
-                        time.sleep(0.5)
-                        if self.printCanceled:
-                            raise PrintCanceledException()
-
-                printingEnd = time.time()
-                self.argentum.addTimeSpentPrinting(printingEnd - printingStart)
-                printingStart = time.time()
-
-            self.argentum.printer.home()
-            self.setProgress(statusText='Print complete.', percent=100)
-
-            printingEnd = time.time()
-            self.argentum.addTimeSpentPrinting(printingEnd - printingStart)
+                        nImage = nImage + 1
+                        self.setProgress(percent=(20 + self.perImage * nImage))
+                    self.argentum.addTimeSpentPrinting(printing.seconds)
+
+                with instrument.span('passEnd', printPass=i + 1) as printing:
+                    if self.printThread.useRollers:
+                        self.dryingLoop()
+
+                    if self.printThread.alsoPause:
+                        self.setProgress(labelText="Pausing before next pass.")
+                        if not self.progress.paused:
+                            self.progress.pause()
+                        self.argentum.printer.moveTo(100, 100, withOk=True)
+                        self.argentum.printer.waitForResponse(timeout=10, expect='Ok')
+                        while self.progress.paused:
+                            time.sleep(0.5)
+                            if self.printCanceled:
+                                raise PrintCanceledException()
+                self.argentum.addTimeSpentPrinting(printing.seconds)
+
+            with instrument.span('home') as printing:
+                self.argentum.printer.home()
+                self.setProgress(statusText='Print complete.', percent=100)
+            self.argentum.addTimeSpentPrinting(printing.seconds)
 
         except PrintCanceledException:
             pass
@@ -1625,6 +1628,8 @@ class PrintImage(PrintRect):
         self.lastResized = None
         self.screenRect = None
         self.visible = True
+        # The slice key of the hex file, see PrintView.processImage.
+        self.hexKey = None
 
         filename = os.path.basename(filename)
         if filename.find('.') != -1:
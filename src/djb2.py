@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+'''
+DJB2 hashes, as the firmware computes them over files and over the blocks of
+a file being received. Each byte is taken as a signed char:
+
+    hash = hash * 33 + c    (mod 2**32)
+
+starting from 5381. Over n bytes that is hash * 33**n plus the sum of each
+byte times 33 to the power of the number of bytes after it, so with numpy a
+whole chunk is one multiply and sum against a table of powers of 33. The
+arithmetic is done in 64 bit unsigned integers, which wrap around at 2**64,
+a multiple of 2**32, so the low 32 bits are exact.
+'''
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DJB2_SEED = 5381
+DJB2_MASK = 0xffffffff
+
+# Bytes hashed at a time, the size of the table of powers.
+CHUNK = 65536
+
+if numpy is not None:
+    # POWERS[k] is 33**k, reversed so the last byte of a chunk of n bytes
+    # is multiplied by 33**0 when using POWERS[-n:].
+    POWERS = numpy.full(CHUNK, 33, dtype=numpy.uint64)
+    POWERS[0] = 1
+    POWERS = numpy.cumprod(POWERS, dtype=numpy.uint64)[::-1].copy()
+
+def asBytes(data):
+    # Text is hashed as it is written to the printer.
+    if isinstance(data, type(u'')):
+        return data.encode('utf-8')
+    return data
+
+def calcDJB2(data, hash=DJB2_SEED):
+    # The hash of data, carrying on from hash so that a file can be hashed a
+    # piece at a time.
+    data = asBytes(data)
+    if numpy is None:
+        for cval in bytearray(data):
+            if cval >= 128:
+                cval = cval - 256
+            hash = (hash * 33 + cval) & DJB2_MASK
+        return hash
+
+    values = numpy.frombuffer(data, dtype=numpy.int8)
+    for start in range(0, len(values), CHUNK):
+        chunk = values[start:start + CHUNK]
+        # Negative bytes become 2**64 + c, which is c modulo 2**64.
+        total = numpy.dot(chunk.astype(numpy.uint64), POWERS[-len(chunk):])
+        hash = (hash * pow(33, len(chunk), 1 << 32) + int(total)) & DJB2_MASK
+    return hash
+
+def blockDJB2(data, blockSize, hash=DJB2_SEED, chain=True):
+    # The hash after each blockSize bytes of data, and after the last partial
+    # block, as sent at the end of each block of a file transfer. Without
+    # chain each block is hashed on its own, starting from hash.
+    data = asBytes(data)
+    seed = hash
+    if numpy is None or blockSize > CHUNK:
+        hashes = []
+        for start in range(0, len(data), blockSize):
+            if not chain:
+                hash = seed
+            hash = calcDJB2(data[start:start + blockSize], hash)
+            hashes.append(hash)
+        return hashes
+
+    values = numpy.frombuffer(data, dtype=numpy.int8)
+    whole = len(values) // blockSize
+    rows = max(1, CHUNK // blockSize)
+    power = pow(33, blockSize, 1 << 32)
+    hashes = []
+    # The sums of the whole blocks, a chunk of blocks at a time.
+    for first in range(0, whole, rows):
+        last = min(whole, first + rows)
+        blocks = values[first * blockSize:last * blockSize].reshape(-1, blockSize)
+        totals = numpy.dot(blocks.astype(numpy.uint64), POWERS[-blockSize:])
+        for total in totals.tolist():
+            if not chain:
+                hash = seed
+            hash = (hash * power + total) & DJB2_MASK
+            hashes.append(hash)
+    if whole * blockSize < len(values):
+        if not chain:
+            hash = seed
+        hashes.append(calcDJB2(values[whole * blockSize:], hash))
+    return hashes
@@ -45,7 +45,9 @@ import requests
 
 import pickle
 
-from imageproc import ImageProcessor
+from qtimageproc import QtImageProcessor
+import instrument
+from slicecache import SliceCache
 
 from Alchemist import OptionsDialog, CommandLineEdit, RollerCalibrationDialog
 
@@ -53,7 +55,7 @@ from setup import VERSION, BASEVERSION, CA_CERTS
 from firmware_updater import update_firmware_list, get_available_firmware, update_local_firmware, is_older_firmware
 
 import subprocess
-from multiprocessing import Process
+from multiprocessing import Process, freeze_support
 import threading
 
 NO_PRINTER = "No printer connected."
@@ -67,7 +69,12 @@ default_options = {
     'x_speed': 8000,
     'y_speed': 8000,
     'x_acc': True,
-    'y_acc': True
+    'y_acc': True,
+    'bidirectional': False,
+    'trim_travel': False,
+    'backlash_forward': 0,
+    'backlash_reverse': 0,
+    'slice_engine': 'auto'
 }
 
 class Argentum(QtGui.QMainWindow):
@@ -78,6 +85,11 @@ class Argentum(QtGui.QMainWindow):
 
         self.loadOptions()
 
+        # Where the timings of slicing, sending and printing go, see
+        # instrument. The environment decides when these aren't set.
+        instrument.configure(self.getOption("instrument", None),
+                             self.getOption("instrument_memory", None))
+
         self.printer = ArgentumPrinterController()
         self.printer.logSerial = self.getOption("log_serial", False)
         self.programmer = None
@@ -595,14 +607,29 @@ class Argentum(QtGui.QMainWindow):
         dilateCount = self.getOption("dilate_count", None)
         if dilateCount:
             dilateCount = int(dilateCount)
-        ip = ImageProcessor(
+        ip = QtImageProcessor(
             horizontal_offset=int(self.options['horizontal_offset']),
             vertical_offset=int(self.options['vertical_offset']),
             overlap=int(self.options['print_overlap']),
             dilateCount=dilateCount
         )
+        # Printing sends compressed files, save doing it at print time.
+        ip.WRITE_COMPRESSED = True
+        ip.BIDIRECTIONAL = self.getOption("bidirectional", False)
+        ip.TRIM_TRAVEL = self.getOption("trim_travel", False)
+        ip.BACKLASH = (self.getIntOption("backlash_forward", 0),
+                       self.getIntOption("backlash_reverse", 0))
+        # See imageproc.SLICE_ENGINES, auto picks one for each image.
+        ip.ENGINE = self.getOption("slice_engine", "auto") or "auto"
+        # Slice with a slicedaemon, when one is set up.
+        ip.DAEMON = self.getOption("slice_daemon", None) or None
         return ip
 
+    def getSliceCache(self):
+        # slice_cache_size is the most disk the cache may use, in megabytes.
+        maxBytes = int(self.getOption("slice_cache_size", 1024)) * 1024 * 1024
+        return SliceCache(os.path.join(self.filesDir, "cache"), maxBytes)
+
     def showImageSelectionDialog(self):
         return str(QtGui.QFileDialog.getOpenFileName(self, 'Select an image to process', self.lastImportDir, "Image Files (*.png *.xpm *.jpg *.svg *.bmp);;All Files (*.*)"))
 
@@ -637,7 +664,15 @@ class Argentum(QtGui.QMainWindow):
             self.processImageThread.outFilename = outputFileName
             print('Writing to ' + outputFileName)
             ip = self.getImageProcessor()
+            cache = self.getSliceCache()
+            key = ip.getSliceKey(inputFileName)
+            if cache.fetch(key, outputFileName):
+                print('Using the cached slice of ' + inputFileName)
+                self.processImageProgressFunc(100, 100)
+                return
             ip.sliceImage(inputFileName, outputFileName, progressFunc=self.processImageProgressFunc)
+            if not self.processImageProgressCancel:
+                cache.store(key, outputFileName)
 
     def processImageProgressFunc(self, pos, size):
         if self.processImageProgressCancel:
@@ -1563,6 +1598,17 @@ class Argentum(QtGui.QMainWindow):
         except:
             return default
 
+    def getIntOption(self, name, default):
+        # An option that should be a whole number, default if it isn't set or
+        # isn't one.
+        value = self.getOption(name, default)
+        try:
+            return int(value or default)
+        except (TypeError, ValueError):
+            print("Option {} should be a whole number, not {!r}, using {}.".format(
+                  name, value, default))
+            return default
+
     def setOption(self, name, value):
         self.options[name] = value
         self.saveOptions()
@@ -1572,7 +1618,6 @@ class Argentum(QtGui.QMainWindow):
         self.saveOptions()
 
     def updatePrinterOptions(self, val):
-        val["last_printer_options_changed"] = time.time()
         self.updateOptions(val)
         if self.printer.connected:
             self.printer.updateOptions(self.options)
@@ -1869,4 +1914,6 @@ def main():
     sys.exit(app.exec_())
 
 if __name__ == '__main__':
+    # Frozen builds run the slicing worker processes through here too.
+    freeze_support()
     main()
@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# The order the firing commands of a column have to come in. A compressed
+# firing line has one firing per address in this order, so the addresses
+# themselves are left out.
+order = ['8', '4', 'C', '2', 'A', '6', 'E', '1', '9', '5', 'D', '3', 'B'];
+MAX_FIRING_LINE_LEN = 13*4+12
+
+def compressedPath(path):
+    # Where the slicer writes the compressed form of the hex file at path.
+    return path + 'b'
+
+'''
+Compresses hex file commands into the format the printer's "recv b" command
+takes. Movements are kept, minus the "M " (and the "Y " of Y moves), and the
+13 firings of each column become one line, or "d" when the line is the same
+as the last one. Firings the same as the last firing are left empty, "z"
+stands for a zero byte and a byte already seen recently is replaced with a
+letter referring back to it.
+
+Lines can be given one at a time with line() or the slicer can feed the
+movements, firing tokens and firing lines directly. Once something can't be
+compressed, failed is set and everything else is ignored.
+'''
+class HexCompressor:
+    def __init__(self, debug=None):
+        self.debug = debug
+        self.compressed = []
+        self.lastFiringLine = None
+        self.lastFiring = None
+        self.lastParts = []
+        self.firings = []
+        # Whether a firing line has been added since the last movement.
+        self.fired = False
+        self.failed = False
+
+    def fail(self, msg):
+        if self.debug:
+            self.debug(msg)
+        self.failed = True
+        return False
+
+    def line(self, line):
+        if self.failed:
+            return False
+        if len(line) == 0:
+            return True
+        if line[0] == '#':
+            self.compressed.append(line)
+            return True
+
+        if line[0] == 'M':
+            return self.movement(line[2:3], line[4:])
+        elif line[0] == 'F':
+            return self.firing(line[2:3], line[3:])
+        else:
+            return self.fail("what's this? {}".format(line))
+
+    def movement(self, axis, steps):
+        if len(self.firings) > 0:
+            if len(self.firings) != len(order):
+                return self.fail("firing order changed!")
+            for i in range(len(self.firings)):
+                if self.firings[i][0] != order[i]:
+                    return self.fail("firing order changed!")
+            firingLine = ','.join(firing[1] for firing in self.firings)
+            self.firings = []
+            if not self.firingLine(firingLine):
+                return False
+        self.movementLine(axis, steps)
+        return not self.failed
+
+    def movementLine(self, axis, steps):
+        self.fired = False
+        if axis == 'X':
+            self.compressed.append('X{}'.format(steps))
+        else:
+            self.compressed.append('{}'.format(steps))
+
+    def firing(self, address, value):
+        self.firings.append((address, self.firingToken(value)))
+        return True
+
+    def firingToken(self, value):
+        # value is the 4 hex digits of a firing command. Returns what goes
+        # in the firing line for it.
+        if self.lastFiring and value == self.lastFiring:
+            return ''
+        self.lastFiring = value
+
+        part = None
+        if value == "0000":
+            token = 'z'
+        elif value[0:2] == "00":
+            part = value[2:4]
+            token = 'z'
+        elif value[2:4] == "00":
+            part = value[0:2]
+            token = ''
+        else:
+            token = value
+        if part:
+            if part in self.lastParts:
+                token = token + chr(ord('a') + self.lastParts.index(part))
+            else:
+                self.lastParts.append(part)
+                if len(self.lastParts) > 25:
+                    self.lastParts.pop(0)
+                token = token + part
+        return token
+
+    def firingLine(self, firingLine):
+        self.fired = True
+        if firingLine == "":
+            firingLine = "."
+        if self.lastFiringLine and firingLine == self.lastFiringLine:
+            self.compressed.append('d')
+        else:
+            self.compressed.append(firingLine)
+        self.lastFiringLine = firingLine
+        if len(firingLine) > MAX_FIRING_LINE_LEN:
+            return self.fail("firing line too long.")
+        return True
+
+    def getState(self):
+        # What the compression of the next line depends on. Passes compressed
+        # from the same state compress the same, see sliceindex.
+        return [self.lastFiringLine, self.lastFiring, list(self.lastParts), self.fired]
+
+    def setState(self, state):
+        self.lastFiringLine, self.lastFiring, lastParts, self.fired = state
+        self.lastParts = list(lastParts)
+
+    def getvalue(self):
+        if self.failed:
+            return None
+        return '\n'.join(self.compressed) + "\n"
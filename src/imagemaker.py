@@ -23,12 +23,19 @@
 """
 
 import sys
-from imageproc import ImageProcessor
+from imageproc import ImageProcessor, SLICE_ENGINES
 
-if len(sys.argv) > 1:
+args = sys.argv[1:]
+engine = 'auto'
+if len(args) > 1 and args[0] == '-e':
+    engine = args[1]
+    args = args[2:]
+
+if len(args) > 0:
     ip = ImageProcessor()
+    ip.ENGINE = engine
 
-    inputFileName = sys.argv[1]
+    inputFileName = args[0]
 
     dotPosition = inputFileName.rfind('.')
 
@@ -39,4 +46,5 @@ if len(sys.argv) > 1:
 
     ip.sliceImage(inputFileName, outputFileName)
 else:
-    print('usage: {} <filename>'.format(sys.argv[0]))
+    print('usage: {} [-e auto|{}] <filename>'.format(sys.argv[0],
+          '|'.join(e.name for e in SLICE_ENGINES)))
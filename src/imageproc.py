@@ -23,11 +23,28 @@
 """
 
 from PIL import Image
-from PyQt4.QtGui import QImage, QTransform
-from PyQt4 import QtCore
 import os
 import sys
+import ast
 import time
+import copy
+import collections
+import hashlib
+import multiprocessing
+import instrument
+from hexcompress import HexCompressor, compressedPath
+import djb2
+from sliceindex import SliceIndex, PreviousSlice, indexPath, passDigest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None
 ### Image Processing Functions
 
 """
@@ -43,15 +60,172 @@ try:
 except NameError:
     xrange = range
 
-def calcDJB2(contents):
-    hash = 5381
-    for c in contents:
-        cval = ord(c)
-        if cval >= 128:
-            cval = -(256 - cval)
-        hash = hash * 33 + cval
-        hash = hash & 0xffffffff
-    return hash
+# Lookup tables to convert address to position, see calculateFiring.
+FIRING_POSITIONS = (
+    (0, 10, 7, 4, 1, 11, 8, 5, 2, 12, 9, 6, 3),
+    (9, 6, 3, 0, 10, 7, 4, 1, 11, 8, 5, 2, 12)
+)
+
+def firingAddress(a):
+    # The multiplexer doesn't use the first output, for startup reasons.
+    a = a + 1
+
+    address =  (a & 0b00000001) << 3
+    address += (a & 0b00000010) << 1
+    address += (a & 0b00000100) >> 1
+    address += (a & 0b00001000) >> 3
+
+    return address
+
+# Lookup tables for writing firing commands, the multiplexer address of each
+# of the 13 addresses and the hex digits of each byte value.
+FIRING_ADDRESSES = tuple(firingAddress(a) for a in range(13))
+HEX_BYTES = tuple('{:02X}'.format(i).encode('utf-8') for i in range(256))
+TEXTUAL_FIRING_PREFIXES = tuple('F {:01X}'.format(address).encode('utf-8')
+                                for address in FIRING_ADDRESSES)
+
+if numpy is not None:
+    HEX_TABLE = numpy.frombuffer(b''.join(HEX_BYTES), dtype=numpy.uint8).reshape(256, 2)
+    TEXTUAL_FIRING_PREFIX_TABLE = numpy.frombuffer(b''.join(TEXTUAL_FIRING_PREFIXES),
+                                                   dtype=numpy.uint8).reshape(13, 3)
+
+# Movement commands already formatted, by axis and steps.
+MOVEMENT_COMMANDS = {}
+
+# calcDJB2 used to be defined here, it is kept for code importing it from here.
+calcDJB2 = djb2.calcDJB2
+
+'''
+A one bit per pixel plane, packed 8 pixels to a byte along each row. The plane
+sits at location on the output image, which is never allocated, pasting is
+just an offset applied to the row and column indexes. When streaming, packed
+only holds the rows of the plane from first on, out of height rows in total.
+'''
+class PackedPlane:
+    def __init__(self, packed, width, location=(0, 0), first=0, height=None):
+        self.packed = packed
+        self.width = width
+        self.x, self.y = location
+        self.first = first
+        if height is None:
+            height = len(packed)
+        self.height = height
+
+    def occupancy(self, rows, width):
+        # Returns which of the columns of the given output width have ink in
+        # any of the given output image rows. The rows are ORed together
+        # while still packed, so only the result is unpacked.
+        out = numpy.zeros(width, dtype=bool)
+        rows = numpy.asarray(rows) - self.y
+        valid = (rows >= 0) & (rows < self.height)
+        left = max(self.x, 0)
+        right = min(self.x + self.width, width)
+        if right > left and valid.any():
+            packed = numpy.bitwise_or.reduce(self.packed[rows[valid] - self.first], axis=0)
+            pixels = numpy.unpackbits(packed)[:self.width]
+            out[left:right] = pixels[left - self.x:right - self.x]
+        return out
+
+    def rows(self, rows):
+        # Returns the given output image rows, still packed. Rows outside of
+        # the plane are blank.
+        rows = numpy.asarray(rows) - self.y
+        valid = (rows >= 0) & (rows < self.height)
+        out = numpy.zeros((len(rows), (self.width + 7) // 8), dtype=numpy.uint8)
+        out[valid] = self.packed[rows[valid] - self.first]
+        return out
+
+    def unpackColumns(self, rows, columns):
+        # Returns the given output image rows and columns as a boolean array.
+        # Everything outside of the plane is off.
+        rows = numpy.asarray(rows) - self.y
+        valid = (rows >= 0) & (rows < self.height)
+        columns = numpy.asarray(columns) - self.x
+        inside = (columns >= 0) & (columns < self.width)
+        if not (inside.any() and valid.any()):
+            return numpy.zeros((len(rows), len(columns)), dtype=bool)
+
+        # Read just the bytes holding the columns, anything outside of the
+        # plane reads the first byte and is cleared afterwards.
+        rows = numpy.where(valid, rows - self.first, 0)
+        columns = numpy.where(inside, columns, 0)
+        packed = self.packed[rows][:, columns >> 3]
+        shifts = (7 - (columns & 7)).astype(numpy.uint8)
+        pixels = ((packed >> shifts) & 1).astype(bool)
+        pixels &= valid[:, None]
+        pixels &= inside
+        return pixels
+
+    def window(self, top, bottom):
+        # A plane holding only the rows needed to read output rows top to
+        # bottom, sharing the packed data.
+        end = self.first + len(self.packed)
+        first = min(max(top - self.y, self.first), end)
+        last = min(max(bottom - self.y, first), end)
+        packed = self.packed[first - self.first:last - self.first]
+        return PackedPlane(packed, self.width, (self.x, self.y), first, self.height)
+
+'''
+Produces the four planes of a slice a band at a time as the passes move down
+the image, instead of splitting and dilating the whole image up front. Only
+the rows that the current pass reads are kept, plus the rows ahead of it up
+to a band of STREAM_ROWS, so memory depends on the width and not the height.
+'''
+class PlaneStream:
+    def __init__(self, processor, pixels):
+        self.processor = processor
+        self.pixels = pixels
+
+        imageHeight, self.width = pixels.shape[:2]
+
+        # Rows in each plane, see splitPlanes.
+        self.height = (imageHeight + (-imageHeight % 4)) // 2
+
+        empty = numpy.zeros((0, (self.width + 7) // 8), dtype=numpy.uint8)
+        self.planes = [
+                PackedPlane(empty, self.width, location, 0, self.height)
+                for location in processor.getPasteLocations()
+        ]
+        self.first = 0
+        self.last = 0
+
+    def advance(self, top, bottom):
+        # Make output rows top to bottom readable from all of the planes.
+        first = min(max(min(top - plane.y for plane in self.planes), 0), self.height)
+        last = min(max(max(bottom - plane.y for plane in self.planes), 0), self.height)
+
+        if last > self.last:
+            start = max(self.last, first)
+            end = min(max(last, start + self.processor.STREAM_ROWS), self.height)
+            band = self.band(start, end)
+            for plane, rows in zip(self.planes, band):
+                if start == self.last:
+                    rows = numpy.vstack((plane.packed[first - plane.first:], rows))
+                plane.packed = rows
+                plane.first = start if start != self.last else first
+            self.last = end
+        else:
+            for plane in self.planes:
+                plane.packed = plane.packed[first - plane.first:]
+                plane.first = first
+        self.first = first
+
+    def band(self, start, end):
+        # Plane rows start to end of the two split and two dilated planes.
+        # Dilation needs dilateCount rows either side, and the split works on
+        # groups of 4 image rows, which is 2 rows of each plane.
+        count = self.processor.dilateCount
+        top = max(start - count, 0)
+        top -= top % 2
+        bottom = min(end + count, self.height)
+        bottom += bottom % 2
+
+        inputs = self.processor.splitBand(self.pixels, top * 2, bottom * 2)
+        inputs = [PackedPlane(packed, self.width) for packed in inputs]
+        inputs2 = self.processor.dilatePlanes(inputs, count)
+
+        sources = (inputs[0], inputs[1], inputs2[0], inputs2[1])
+        return [source.packed[start - top:end - top] for source in sources]
 
 class ImageProcessor:
     # Distance between the same line of primitives on two different heads (in pixels)
@@ -86,6 +260,66 @@ class ImageProcessor:
     # This allows for easier inspection of hex files
     USE_TEXTUAL_FIRING = True
 
+    # Size of the output file buffer, commands are written out in chunks.
+    OUTPUT_BUFFER = 1 << 20
+
+    # Also write the compressed form the printer receives next to the output
+    # file (see hexcompress), so it doesn't need compressing when it is sent.
+    # Only textual firing with fps of 1 can be compressed.
+    WRITE_COMPRESSED = False
+    compressor = None
+
+    # Slice with numpy arrays when numpy is available. The per pixel code is
+    # kept as the reference implementation and produces identical output.
+    USE_ARRAYS = True
+
+    # Split and dilate the image a band at a time while writing the passes,
+    # rather than all at once. Needs USE_ARRAYS. Same output, less memory.
+    STREAMING = False
+
+    # Number of plane rows a streaming slice works on at a time.
+    STREAM_ROWS = 256
+
+    # Number of processes computing passes in parallel. Needs USE_ARRAYS and
+    # concurrent.futures. Each process is sent PASS_CHUNK passes at a time.
+    PROCESSES = 1
+    PASS_CHUNK = 16
+
+    # Hold back the line feed of each pass until the next pass that has ink,
+    # so a band of blank passes is fed over with one X move instead of a
+    # move per pass. Inked passes start at the same place either way.
+    MERGE_BLANK_PASSES = True
+
+    # Print odd passes right to left, instead of returning the head to column
+    # 0 after every pass. The head only returns at the end of the file.
+    BIDIRECTIONAL = False
+
+    # Don't return the head to column 0 after every pass either, but move it
+    # from the last column of a pass straight to the first column of the
+    # next. The head only returns at the end of the file.
+    TRIM_TRAVEL = False
+
+    # Steps added to the Y position of the columns the head gets to moving
+    # forward (left to right) and in reverse, to make up for backlash in the
+    # Y axis. Only used when BIDIRECTIONAL or TRIM_TRAVEL, as otherwise every
+    # column is got to moving forward.
+    BACKLASH = (0, 0)
+
+    # Write an index of the passes next to the output file (see sliceindex),
+    # so the next slice to the same file only has to slice, encode and
+    # compress the passes that changed and can copy the rest. Needs
+    # USE_ARRAYS. Off by default, as it moves the old files aside and leaves
+    # an index file next to the output.
+    INCREMENTAL = False
+    index = None
+    previous = None
+
+    # The slicing engine (see SLICE_ENGINES) to use, or auto to choose the
+    # fastest for the size of the image and the number of cores. None leaves
+    # USE_ARRAYS and PROCESSES as they are. The GUI and the command line
+    # default to auto.
+    ENGINE = None
+
     def __init__(self, horizontal_offset=None, vertical_offset=None, overlap=None, dilateCount=None):
         if horizontal_offset:
             self.HEADOFFSET = horizontal_offset
@@ -99,55 +333,234 @@ class ImageProcessor:
         if dilateCount != None:
             self.dilateCount = dilateCount
 
+    # Change this whenever the slicer output changes, it is part of the slice
+    # keys so hex files sliced before the change aren't used after it.
+    SLICE_VERSION = 2
+
+    # Called with the name and the time in seconds of each stage of a slice:
+    # transform, split, dilate, paste and writeCommands.
+    stageFunc = None
+
+    # The instrument span of the slice being done.
+    span = None
+
+    def stageDone(self, name, start):
+        # Reports the stage that began at start, returns when the next began.
+        now = time.time()
+        if self.span:
+            self.span.stage(name, now - start)
+        if self.stageFunc:
+            self.stageFunc(name, now - start)
+        return now
+
+    def getSliceParameters(self):
+        # Everything besides the image that the output of sliceImage depends on.
+        return (self.SLICE_VERSION, self.HEADOFFSET, self.PRIMITIVEOFFSET,
+                self.VOFFSET, self.SPN, self.mOffset, self.dilateCount,
+                self.fps, self.USE_TEXTUAL_FIRING, self.MERGE_BLANK_PASSES,
+                self.BIDIRECTIONAL, self.TRIM_TRAVEL, tuple(self.BACKLASH))
+
+    def getSliceKey(self, inputFileName, size=None):
+        # A digest of the pixels of the image and the slice parameters. Equal
+        # keys mean equal hex files, see slicecache.
+        inputImage = self.loadImage(inputFileName)
+        description, data = self.imageData(inputImage)
+        digest = hashlib.sha1()
+        digest.update(repr(description + (size, self.getSliceParameters())).encode('utf-8'))
+        digest.update(data)
+        return digest.hexdigest()
+
+    '''
+    Images are PIL images. The methods from here to transformedImage are all
+    that touch them, so a subclass can slice other kinds of images, like the
+    QImages of QtImageProcessor.
+    '''
+    def loadImage(self, inputFileName):
+        if type(inputFileName) == type(''):
+            image = Image.open(inputFileName)
+            image.load()
+            return image
+        return inputFileName
+
+    # Set by imagePixels when the pixels are a view of memory owned by an
+    # image that has to be kept until the slice is done.
+    pixelImage = None
+
+    def imageSize(self, image):
+        return image.size
+
+    def scaleImage(self, image, size):
+        return image.resize(size, Image.BILINEAR)
+
+    def imageData(self, image):
+        # A description of the image and its pixel data, for getSliceKey.
+        return ((image.size[0], image.size[1], image.mode), image.tobytes())
+
+    def imagePixels(self, image):
+        # The red of each pixel of the image as a (height, width) array. Red
+        # is what decides whether a pixel is printed.
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA')
+        return numpy.asarray(image.getchannel(0))
+
+    def transformedPixels(self, image):
+        # The pixels mirrored left to right and then rotated 90 degrees
+        # clockwise, the way transformedImage transforms the image, as a
+        # view. Row r, column c of the result is pixel (width - 1 - r,
+        # height - 1 - c) of the image.
+        pixels = self.imagePixels(image)
+        return pixels[::-1, ::-1].T
+
+    def transformedImage(self, image):
+        # The image mirrored left to right and rotated 90 degrees clockwise,
+        # as an RGBA PIL image for the reference path. Its bands are in the
+        # order Qt keeps pixels in memory, blue, green, red and alpha, so the
+        # red of a pixel is [2], which is what the reference path reads.
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        image = image.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
+        red, green, blue, alpha = image.split()
+        return Image.merge('RGBA', (blue, green, red, alpha))
+
     def sliceImage(self, inputFileName, outputFileName, progressFunc=None, size=None):
+        # Every slice is done by its own copy of the processor, which holds
+        # the output file and all the images and planes of that slice. So any
+        # number of slices can run at once on different threads, even when
+        # they were started from the same ImageProcessor.
+        job = copy.copy(self)
+        job.span = instrument.span('slice', output=os.path.basename(outputFileName),
+                                   dilateCount=self.dilateCount)
+        try:
+            with job.span:
+                return job.sliceImageJob(inputFileName, outputFileName, progressFunc, size)
+        finally:
+            if job.previous:
+                job.previous.close()
+
+    def sliceVariants(self, inputFileName, variants, progressFunc=None, size=None):
+        # Slices one image into a hex file for each of variants, a list of
+        # (outputFileName, options) where options maps processor attributes,
+        # such as mOffset, dilateCount or HEADOFFSET, to their values for that
+        # file. The image is transformed and split once and the dilations are
+        # built up in order of dilateCount, each from the one before, so only
+        # the stages after them are done for every variant. progressFunc is
+        # called with the number of files written so far.
+        job = copy.copy(self)
+        job.span = instrument.span('sliceVariants', variants=len(variants))
+        with job.span:
+            return job.sliceVariantsJob(inputFileName, variants, progressFunc, size)
+
+    def sliceVariantsJob(self, inputFileName, variants, progressFunc=None, size=None):
+        start = time.time()
+
+        inputImage = self.loadImage(inputFileName)
+        if size:
+            inputImage = self.scaleImage(inputImage, size)
+        self.chooseEngine(inputImage)
+
+        # The reference engine keeps nothing worth sharing between slices.
+        if not self.USE_ARRAYS or numpy is None:
+            for n, (outputFileName, options) in enumerate(variants):
+                self.variant(options).sliceImage(inputImage, outputFileName)
+                if progressFunc:
+                    if not progressFunc(n + 1, len(variants)):
+                        return
+            return
+
+        pixels = self.transformedPixels(inputImage)
+        start = self.stageDone("transform", start)
+
+        # Every variant prints the same split planes.
+        inputs = self.splitPlanes(pixels)
+        pixels = None
+        start = self.stageDone("split", start)
+
+        order = sorted(range(len(variants)),
+                       key=lambda n: variants[n][1].get('dilateCount', self.dilateCount))
+        dilated = inputs
+        dilateCount = 0
+        for done, n in enumerate(order):
+            outputFileName, options = variants[n]
+            variant = self.variant(options)
+
+            # Dilating by count is dilating by count - 1 and then once more,
+            # so carry on from the last variant's planes.
+            if variant.dilateCount > dilateCount:
+                dilated = self.dilatePlanes(dilated, variant.dilateCount - dilateCount)
+                dilateCount = variant.dilateCount
+                self.stageDone("dilate", start)
+
+            variant.openOutput(outputFileName)
+            try:
+                variant.writePlanes(inputs, dilated)
+            finally:
+                if variant.previous:
+                    variant.previous.close()
+            start = time.time()
+
+            if progressFunc:
+                if not progressFunc(done + 1, len(variants)):
+                    return
+
+    def variant(self, options):
+        # A copy of this processor with some of its attributes changed. The
+        # engine is already chosen, so the copy doesn't choose one again.
+        variant = copy.copy(self)
+        variant.ENGINE = None
+        for name, value in options.items():
+            setattr(variant, name, value)
+        return variant
+
+    def chooseEngine(self, image):
+        if self.ENGINE:
+            width, height = self.imageSize(image)
+            engine = selectSliceEngine(self.ENGINE, width * height)
+            engine.configure(self)
+            if self.span:
+                self.span.set(engine=engine.name)
+
+    def sliceImageJob(self, inputFileName, outputFileName, progressFunc=None, size=None):
         #directory = direct
-        # Global variables to hold the images we are working with
-        global outputImages
-        global pixelMatrices
+        # The images we are working with
+        self.outputImages = []
+        self.pixelMatrices = []
 
         start = time.time()
 
-        outputImages = []
-        pixelMatrices = []
+        # Open our image and split it into its odd rows and even rows
+        inputImage = self.loadImage(inputFileName)
+        if size:
+            inputImage = self.scaleImage(inputImage, size)
 
-        outputFile = open(outputFileName, 'wb')
+        # Now the size of the image is known, choose how to slice it.
+        self.chooseEngine(inputImage)
 
-        # Go to our working directory and open/create the output file
-        #os.chdir(directory)
-        #hexOutput = outputFile
-        self.outputFile = outputFile
-        self.outputFileName = outputFileName
+        self.openOutput(outputFileName)
 
-        # Open our image and split it into its odd rows and even rows
-        if type(inputFileName) == type(''):
-            inputImage = QImage(inputFileName)
+        # The array slicer reads the pixels through the mirror and rotation
+        # (see transformedPixels) rather than making transformed copies.
+        pixels = None
+        if self.USE_ARRAYS and numpy is not None:
+            pixels = self.transformedPixels(inputImage)
         else:
-            inputImage = inputFileName
-        if size:
-            width, height = size
-            inputImage = inputImage.scaled(width, height, aspectRatioMode=QtCore.Qt.IgnoreAspectRatio, transformMode=QtCore.Qt.SmoothTransformation)
-        inputImage = inputImage.mirrored(horizontal=True, vertical=False)
-        #rot270 = QTransform()
-        #rot270.rotate(270)
-        #inputImage = inputImage.transformed(rot270)
-        rot90 = QTransform()
-        rot90.rotate(90)
-        inputImage = inputImage.transformed(rot90)
-
-        print("after transformed {}".format(time.time() - start))
-        start = time.time()
+            inputImage = self.transformedImage(inputImage)
+
+        start = self.stageDone("transform", start)
 
         if progressFunc:
             if not progressFunc(10, 100):
                 return
 
+        if pixels is not None:
+            self.sliceImageArrays(pixels, progressFunc)
+            return
+
         inputs = self.splitImageTwos(inputImage)
         if progressFunc:
             if not progressFunc(25, 100):
                 return
 
-        print("after splitImageTwos {}".format(time.time() - start))
-        start = time.time()
+        start = self.stageDone("split", start)
 
         # Get the size of the input images and adjust width to be that of the output
         width, height = inputs[0].size
@@ -160,17 +573,73 @@ class ImageProcessor:
         height += (104 * 2)
 
         # Create the output images and put them into a list for easy referencing
-        outputImages = [
+        self.outputImages = [
                 Image.new('RGBA', (width , height), (255, 255, 255, 255))
                 for i in range(4)
         ]
 
         # Paste the split input image into correct locations on output images
+        pasteLocations = self.getPasteLocations()
+
+        inputs2 = inputs
+        if self.dilateCount > 0:
+            tot = 50.0 / self.dilateCount
+        for i in range(self.dilateCount):
+            inputs2 = [ self.dilate(inputs2[0]), self.dilate(inputs2[1]) ]
+            if progressFunc:
+                if not progressFunc(25 + (i + 1) * tot, 100):
+                    return
+
+        start = self.stageDone("dilate", start)
+
+        self.outputImages[0].paste(inputs[0], pasteLocations[0])
+        self.outputImages[1].paste(inputs[1], pasteLocations[1])
+        self.outputImages[2].paste(inputs2[0], pasteLocations[2])
+        self.outputImages[3].paste(inputs2[1], pasteLocations[3])
+
+        self.pixelMatrices = [
+            self.outputImages[i].load()
+            for i in range(4)
+        ]
+
+        start = self.stageDone("paste", start)
+
+        # We have our input images and their matrices. Now we need to generate
+        # the correct output data.
+        self.writeCommands(progressFunc)
+
+        start = self.stageDone("writeCommands", start)
+
+    def openOutput(self, outputFileName):
+        # The last slice to this file, before it is overwritten.
+        self.index = None
+        self.previous = None
+        if self.INCREMENTAL and self.USE_ARRAYS and numpy is not None:
+            self.previous = PreviousSlice.load(outputFileName, self.getSliceParameters())
+            self.index = SliceIndex(self.getSliceParameters())
+        elif os.path.exists(indexPath(outputFileName)):
+            os.remove(indexPath(outputFileName))
 
+        outputFile = open(outputFileName, 'wb', self.OUTPUT_BUFFER)
+
+        # Go to our working directory and open/create the output file
+        #os.chdir(directory)
+        #hexOutput = outputFile
+        self.outputFile = outputFile
+        self.outputFileName = outputFileName
+
+        # Any compressed file from an earlier slice is out of date now.
+        if os.path.exists(compressedPath(outputFileName)):
+            os.remove(compressedPath(outputFileName))
+        self.compressor = None
+        if self.WRITE_COMPRESSED and self.USE_TEXTUAL_FIRING and self.fps == 1:
+            self.compressor = HexCompressor()
+
+    def getPasteLocations(self):
         # (0, VOFFSET + 104) = (0, 104)
         # (PRIMITIVEOFFSET, VOFFSET + 104) = (12, 104)
 
-        pasteLocations = (
+        return (
             (
                 self.HEADOFFSET,
                 int((int(208 / self.mOffset) * self.mOffset) / 2)
@@ -189,37 +658,498 @@ class ImageProcessor:
             )
         )
 
-        inputs2 = inputs
-        if self.dilateCount > 0:
-            tot = 50.0 / self.dilateCount
-        for i in range(self.dilateCount):
-            inputs2 = [ self.dilate(inputs2[0]), self.dilate(inputs2[1]) ]
-            if progressFunc:
-                if not progressFunc(25 + (i + 1) * tot, 100):
-                    return
+    def sliceImageArrays(self, pixels, progressFunc=None):
+        start = time.time()
+
+        if self.STREAMING:
+            stream = PlaneStream(self, pixels)
+            self.outputSize = self.getOutputSize(stream.width, stream.height)
+            self.planes = stream.planes
+            self.writeCommandsArrays(progressFunc, stream)
+            self.stageDone("writeCommands", start)
+            return
+
+        # Packed one bit planes, a bit is set where the pixel is on.
+        inputs = self.splitPlanes(pixels)
+        if progressFunc:
+            if not progressFunc(25, 100):
+                return
+
+        start = self.stageDone("split", start)
 
-        print("after dilute {}".format(time.time() - start))
+        inputs2 = self.dilatePlanes(inputs, self.dilateCount, progressFunc)
+        if inputs2 is None:
+            return
+
+        start = self.stageDone("dilate", start)
+
+        self.writePlanes(inputs, inputs2, progressFunc)
+
+    def writePlanes(self, inputs, inputs2, progressFunc=None):
+        # The split planes are printed on the first two passes of each
+        # position and the dilated planes on the other two.
         start = time.time()
 
-        outputImages[0].paste(inputs[0], pasteLocations[0])
-        outputImages[1].paste(inputs[1], pasteLocations[1])
-        outputImages[2].paste(inputs2[0], pasteLocations[2])
-        outputImages[3].paste(inputs2[1], pasteLocations[3])
+        self.outputSize = self.getOutputSize(inputs[0].width, inputs[0].height)
 
-        pixelMatrices = [
-            outputImages[i].load()
-            for i in range(4)
+        sources = (inputs[0], inputs[1], inputs2[0], inputs2[1])
+        self.planes = [
+                PackedPlane(source.packed, source.width, location)
+                for source, location in zip(sources, self.getPasteLocations())
         ]
 
-        print("after paste {}".format(time.time() - start))
-        start = time.time()
+        start = self.stageDone("paste", start)
 
-        # We have our input images and their matrices. Now we need to generate
-        # the correct output data.
-        self.writeCommands(progressFunc)
+        self.writeCommandsArrays(progressFunc)
 
-        print("after write commands {}".format(time.time() - start))
-        start = time.time()
+        self.stageDone("writeCommands", start)
+
+    def getOutputSize(self, width, height):
+        # Same output size as the RGBA images of the reference path. They are
+        # never allocated, the planes are read through their paste locations.
+        width += self.HEADOFFSET + self.PRIMITIVEOFFSET
+        height += (self.mOffset - height % self.mOffset)
+        height += (104 * 2)
+        return (width, height)
+
+    # Number of input rows thresholded at a time by splitPlanes.
+    SPLIT_ROWS = 1024
+
+    '''
+    Splits the (height, width) pixels of an image into two packed planes, the
+    array equivalent of splitImageTwos followed by the "red <= 200" test.
+    '''
+    def splitPlanes(self, pixels):
+        height, width = pixels.shape[:2]
+
+        # Pad to a multiple of 4 rows, the padding is blank.
+        rows = height + (-height % 4)
+        odd = numpy.zeros((rows // 2, (width + 7) // 8), dtype=numpy.uint8)
+        even = numpy.zeros((rows // 2, (width + 7) // 8), dtype=numpy.uint8)
+
+        # Only ever hold SPLIT_ROWS rows unpacked.
+        for top in xrange(0, height, self.SPLIT_ROWS):
+            bottom = top // 2 + (min(self.SPLIT_ROWS, rows - top)) // 2
+            odd[top // 2:bottom], even[top // 2:bottom] = self.splitBand(
+                    pixels, top, top + self.SPLIT_ROWS)
+
+        return (PackedPlane(odd, width), PackedPlane(even, width))
+
+    def splitBand(self, pixels, top, bottom):
+        # Image rows top to bottom as packed odd and even plane rows. top is
+        # a multiple of 4, rows past the end of the image are blank.
+        height, width = pixels.shape[:2]
+        on = pixels[top:bottom] <= 200
+        rows = min(bottom, height + (-height % 4)) - top
+        if len(on) < rows:
+            on = numpy.vstack((on, numpy.zeros((rows - len(on), width), dtype=bool)))
+
+        # Rows 0 and 1 of every 4 are odd, rows 2 and 3 are even.
+        on = on.reshape(-1, 4, width)
+        odd = numpy.packbits(on[:, 0:2].reshape(-1, width), axis=1)
+        even = numpy.packbits(on[:, 2:4].reshape(-1, width), axis=1)
+
+        return (odd, even)
+
+    def dilatePlanes(self, planes, count, progressFunc=None):
+        # count iterations of dilate turn on every pixel within count pixels
+        # of an on pixel in both directions, i.e. a (2*count + 1) square max
+        # filter. That separates into a vertical and a horizontal pass over
+        # each plane. Pixels outside the plane are off, just like in dilate.
+        if count == 0:
+            return list(planes)
+
+        tot = 50.0 / count
+
+        # Rows are whole bytes, so the vertical pass is a plain OR.
+        columns = []
+        for plane in planes:
+            out = plane.packed.copy()
+            for d in range(1, count + 1):
+                out[d:] |= plane.packed[:-d]
+                out[:-d] |= plane.packed[d:]
+            columns.append(out)
+
+        # The horizontal pass shifts the bits one pixel further left and right
+        # each iteration. Bits shifted past the width of the plane are dropped.
+        width = planes[0].width
+        mask = (0xff << (-width % 8)) & 0xff
+        outputs = [column.copy() for column in columns]
+        lefts = list(columns)
+        rights = list(columns)
+        for i in range(count):
+            for n in range(len(outputs)):
+                left = lefts[n] << 1
+                left[:, :-1] |= lefts[n][:, 1:] >> 7
+                right = rights[n] >> 1
+                right[:, 1:] |= (rights[n][:, :-1] & 1) << 7
+                right[:, -1:] &= mask
+                outputs[n] |= left
+                outputs[n] |= right
+                lefts[n] = left
+                rights[n] = right
+            if progressFunc:
+                if not progressFunc(25 + (i + 1) * tot, 100):
+                    return None
+
+        return [PackedPlane(output, width) for output in outputs]
+
+    def writeCommandsArrays(self, progressFunc=None, stream=None):
+        width, height = self.outputSize
+
+        # Ignore empty pixels added to the bottom of the file.
+        height -= (int(208/self.mOffset) * self.mOffset)
+
+        passes = int(height/self.mOffset)*2 + 1
+
+        previous = self.previous
+        if previous:
+            # Passes are only sliced and encoded when they changed, see below.
+            blocks = ((None, None, None) for y in xrange(passes))
+        elif self.PROCESSES > 1 and ProcessPoolExecutor is not None:
+            blocks = self.poolPassCommands(passes, stream)
+        else:
+            blocks = (self.passCommands(y, stream) for y in xrange(passes))
+
+        feed = 0
+        yposition = 0
+        tot = 25.0 / passes
+        for y, (block, sliced, bands) in enumerate(blocks):
+            # Print out progress
+            if progressFunc:
+                if not progressFunc(75 + (y + 1) * tot, 100):
+                    blocks.close()
+                    self.outputFile.close()
+                    os.remove(self.outputFileName)
+                    return
+            else:
+                print('{} out of {}.'.format(y + 1, passes))
+
+            # A pass reading the same rows of the planes as the same pass of
+            # the previous slice, with the head starting it from the same
+            # place, makes the same commands and compresses the same from the
+            # same compressor state, so it is copied instead of sliced.
+            digest = None
+            if self.index:
+                if bands is None:
+                    bands = self.passBands(y, stream)
+                digest = passDigest(bands, (feed, yposition))
+            matched = previous and previous.matches(y, digest)
+            compressor = self.compressor
+            compressedLength = state = lines = None
+            if compressor:
+                state = compressor.getState()
+                before = len(compressor.compressed)
+                if matched:
+                    lines = previous.compressedLines(y, state)
+
+            lead = []
+            if matched and (lines is not None or not compressor or compressor.failed):
+                block = previous.block(y)
+                feed, yposition = previous.endPosition(y)
+            else:
+                if sliced is None:
+                    sliced = self.slicePass(y, stream)
+
+                # Moves made before the pass, the line feeds held back from
+                # the passes before it.
+                if self.MERGE_BLANK_PASSES:
+                    if len(sliced[0]):
+                        if feed:
+                            lead.append(('X', -feed))
+                        feed = 0
+                    feed += self.lineFeed(y)
+
+                # When the head doesn't return to column 0 between passes,
+                # the first move of a pass is from wherever the last pass
+                # left it.
+                if self.chainsPasses() and len(sliced[0]):
+                    moves = sliced[0].copy()
+                    start = int(moves[0])
+                    following = start + int(moves[1]) if len(moves) > 1 else None
+                    first = self.approach(start, yposition, self.passReversed(y), following)
+                    moves[0] = first - yposition
+                    if len(moves) > 1:
+                        moves[1] += start - first
+                    yposition = first + int(moves[1:].sum())
+                    sliced = (moves, sliced[1], sliced[2])
+                    block = None
+
+                # Only the compressed lines have to be made again when the
+                # compressor is in a different state than last time.
+                if matched:
+                    block = previous.block(y)
+                else:
+                    if block is None:
+                        block = self.encodePass(*sliced)
+                    block = b''.join(self.movementCommand(axis, steps)
+                                     for axis, steps in lead) + block
+            self.outputFile.write(block)
+
+            if compressor:
+                if lines is not None:
+                    compressor.compressed.extend(lines)
+                    compressor.setState(previous.endState(y))
+                elif sliced is not None:
+                    for axis, steps in lead:
+                        compressor.movementLine(axis, steps)
+                    self.compressPass(*sliced)
+                compressedLength = sum(len(line) + 1 for line in compressor.compressed[before:])
+            if self.index:
+                self.index.add(digest, len(block), compressedLength, state, (feed, yposition))
+
+        # Carriage return
+        if yposition != 0:
+            self.writeMovementCommand('Y', -yposition)
+
+        if feed:
+            self.writeMovementCommand('X', -feed)
+
+        if self.index and self.compressor:
+            self.index.finalState = self.compressor.getState()
+        if previous and self.span:
+            self.span.set(passes=passes, reusedPasses=previous.reused)
+
+        self.finishOutput()
+
+    def passCommands(self, y, stream=None):
+        # The commands for pass y, what they were made from and, when
+        # writing an index, the digest of the rows of the planes it read.
+        sliced = self.slicePass(y, stream)
+        bands = None
+        if self.INCREMENTAL:
+            bands = self.passBands(y)
+        return (self.encodePass(*sliced), sliced, bands)
+
+    def passBands(self, y, stream=None):
+        # A digest of the rows of the planes that pass y reads, which with
+        # where the head starts it from is all its commands depend on.
+        if stream:
+            top = (y * self.mOffset) // 2
+            stream.advance(top, top + 105)
+        digest = hashlib.sha1()
+        digest.update(repr(self.outputSize).encode('utf-8'))
+        rows = self.passRows(y)
+        for plane in self.planes:
+            digest.update(repr((plane.x, plane.y, plane.width)).encode('utf-8'))
+            digest.update(plane.rows(rows).tobytes())
+        return digest.hexdigest()
+
+    def slicePass(self, y, stream=None):
+        # The Y moves to each inked column of pass y, the (side, address,
+        # column) firings of those columns and the moves that end the pass.
+        # Every pass starts and ends at column 0 and the line feeds only
+        # depend on y, so passes can be made in any order. When passes are
+        # chained, the first move is from column 0 and the pass ends where it
+        # stops, writeCommandsArrays moves it on from the last pass.
+        if stream:
+            top = (y * self.mOffset) // 2
+            stream.advance(top, top + 105)
+
+        # Firings for all the columns of the pass at once, only working them
+        # out for the columns where something fires.
+        reverse = self.passReversed(y)
+        columns = self.passColumns(y)
+        if reverse:
+            columns = columns[::-1]
+        firings = self.calculatePassFirings(y, columns)
+
+        # Where the head moves to for each column, and the moves to get there.
+        ypositions = ((columns + 1) * self.SPN).astype(numpy.int64)
+        if self.chainsPasses():
+            ypositions += self.BACKLASH[reverse]
+        moves = numpy.diff(numpy.concatenate(([0], ypositions)))
+
+        # Carriage return, chained passes return at the end instead.
+        tail = []
+        if len(columns) and not self.chainsPasses():
+            tail.append(('Y', -int(ypositions[-1])))
+
+        # Line feed, unless it's merged with the feeds after it.
+        if not self.MERGE_BLANK_PASSES:
+            tail.append(('X', -self.lineFeed(y)))
+
+        return (moves, firings, tail)
+
+    def chainsPasses(self):
+        # Whether passes follow on from where the last pass ended.
+        return self.BIDIRECTIONAL or self.TRIM_TRAVEL
+
+    def passReversed(self, y):
+        # Whether pass y is printed right to left.
+        return self.BIDIRECTIONAL and y % 2 == 1
+
+    def approach(self, position, yposition, reverse, following=None):
+        # Where to move to for the first column of a chained pass, from
+        # yposition. position has the backlash of the direction of the pass
+        # added, but the head can get to the first column the other way.
+        # following is the position of the next column of the pass, the
+        # correction is left out if it would reach or pass it, which would
+        # fire the first two columns in the same place.
+        backwards = position < yposition
+        if position != yposition and backwards != reverse:
+            corrected = position + self.BACKLASH[backwards] - self.BACKLASH[reverse]
+            if following is None or (following != corrected and
+                                     (following < corrected) == (following < position)):
+                position = corrected
+        return position
+
+    def lineFeed(self, y):
+        # After y passes the head has fed int(mOffset * y * SPN).
+        return int(self.mOffset * (y + 1) * self.SPN) - int(self.mOffset * y * self.SPN)
+
+    def encodePass(self, moves, firings, tail):
+        commands = b''.join(self.movementCommand(axis, steps) for axis, steps in tail)
+        if not len(moves):
+            return commands
+
+        # Each inked column is a Y movement followed by its firings. Lay the
+        # columns out as rows of a buffer, with the movement commands right
+        # aligned from a table of the distinct moves, then drop the padding.
+        values, inverse = numpy.unique(moves, return_inverse=True)
+        movements = [self.movementCommand('Y', int(value)) for value in values]
+        longest = max(len(movement) for movement in movements)
+        table = numpy.zeros((len(values), longest), dtype=numpy.uint8)
+        for row, movement in zip(table, movements):
+            row[longest - len(movement):] = numpy.frombuffer(movement, dtype=numpy.uint8)
+        lengths = numpy.array([len(movement) for movement in movements])[inverse]
+        # Nothing to write for a column the head is already at.
+        lengths[moves == 0] = 0
+
+        lines = self.firingLines(firings).reshape(len(moves), -1)
+        out = numpy.empty((len(moves), longest + lines.shape[1]), dtype=numpy.uint8)
+        out[:, :longest] = table[inverse]
+        out[:, longest:] = lines
+        used = numpy.arange(out.shape[1]) >= (longest - lengths)[:, None]
+
+        return out[used].tobytes() + commands
+
+    def compressPass(self, moves, firings, tail):
+        # Feeds a pass from slicePass to the compressor, in order.
+        compressor = self.compressor
+        if compressor.failed:
+            return
+
+        # A firing the same as the one before it is left out, only the others
+        # have to go through the compressor one at a time.
+        values = ((firings[0].astype(numpy.uint16) << 8) | firings[1]).T.ravel()
+        changed = numpy.ones(len(values), dtype=bool)
+        changed[1:] = values[1:] != values[:-1]
+        if len(values) and compressor.lastFiring and int(compressor.lastFiring, 16) == values[0]:
+            changed[0] = False
+        tokens = [''] * len(values)
+        for i in numpy.flatnonzero(changed).tolist():
+            tokens[i] = compressor.firingToken('{:04X}'.format(int(values[i])))
+
+        # Each column needs a movement before it, as the hex file only tells
+        # where a column ends by the movement after it.
+        for i, move in enumerate(moves.tolist()):
+            if move != 0:
+                compressor.movementLine('Y', move)
+            elif compressor.fired:
+                compressor.fail("firing order changed!")
+                return
+            if not compressor.firingLine(','.join(tokens[i*13:(i + 1)*13])):
+                return
+        for axis, steps in tail:
+            compressor.movementLine(axis, steps)
+
+    def firingLines(self, firings):
+        # The firing commands for a (side, address, column) array of firings,
+        # fps times over, as one flat array of bytes.
+        columns = firings.shape[2]
+        lines = numpy.empty((columns, 13, 8), dtype=numpy.uint8)
+        if self.USE_TEXTUAL_FIRING:
+            lines[:, :, 0:3] = TEXTUAL_FIRING_PREFIX_TABLE
+            lines[:, :, 3:5] = HEX_TABLE[firings[0].T]
+            lines[:, :, 5:7] = HEX_TABLE[firings[1].T]
+            lines[:, :, 7] = ord('\n')
+        else:
+            lines[:, :, 0] = 1
+            lines[:, :, 1] = firings[0].T
+            lines[:, :, 2] = FIRING_ADDRESSES
+            lines[:, :, 3] = ord('\n')
+            lines[:, :, 4] = 1
+            lines[:, :, 5] = firings[1].T
+            lines[:, :, 6] = FIRING_ADDRESSES
+            lines[:, :, 7] = ord('\n')
+        return numpy.tile(lines, (1, self.fps, 1)).ravel()
+
+    def poolPassCommands(self, passes, stream=None):
+        # Generates the commands for each pass, in order, computing them
+        # PASS_CHUNK passes at a time in PROCESSES worker processes. Each
+        # chunk is sent just the rows of the planes that its passes read.
+        job = copy.copy(self)
+        job.outputFile = None
+        job.compressor = None
+        job.planes = None
+        job.index = None
+        job.previous = None
+        job.span = None
+        job.stageFunc = None
+        job.pixelImage = None
+
+        executor = ProcessPoolExecutor(self.PROCESSES)
+        pending = collections.deque()
+        try:
+            for first in xrange(0, passes, self.PASS_CHUNK):
+                if len(pending) >= self.PROCESSES * 2:
+                    for block in pending.popleft().result():
+                        yield block
+
+                chunk = range(first, min(first + self.PASS_CHUNK, passes))
+                top = (chunk[0] * self.mOffset) // 2
+                bottom = (chunk[-1] * self.mOffset) // 2 + 105
+                if stream:
+                    stream.advance(top, bottom)
+                planes = [plane.window(top, bottom) for plane in self.planes]
+                pending.append(executor.submit(passCommandsWorker, job, planes, chunk))
+
+            while pending:
+                for block in pending.popleft().result():
+                    yield block
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def passRows(self, yPos):
+        # The nozzles of a pass cover 52 of every second row starting from
+        # here, address a uses rows positions[a] + 13*i of them.
+        y = (yPos * self.mOffset) // 2
+
+        # ensure that yPos is even
+        if yPos % 2:
+            y += 1
+
+        return numpy.arange(y, y + 104, 2)
+
+    def passColumns(self, yPos):
+        # The columns of a pass where something fires, which are the columns
+        # with ink in any of the rows of the pass in any of the planes.
+        occupied = numpy.zeros(self.outputSize[0], dtype=bool)
+        rows = self.passRows(yPos)
+        for plane in self.planes:
+            occupied |= plane.occupancy(rows, self.outputSize[0])
+        return numpy.flatnonzero(occupied)
+
+    def calculatePassFirings(self, yPos, columns):
+        # The array equivalent of calculateFiring for the given columns and
+        # all addresses of a pass. Returns a (side, address, column) array.
+        rows = self.passRows(yPos)
+        count = len(columns)
+
+        firings = numpy.zeros((2, 13, count), dtype=numpy.uint8)
+        for side in range(2):
+            odd = self.planes[side*2].unpackColumns(rows, columns).reshape(4, 13, count)
+            odd = odd[:, list(FIRING_POSITIONS[0])]
+            even = self.planes[side*2 + 1].unpackColumns(rows, columns).reshape(4, 13, count)
+            even = even[:, list(FIRING_POSITIONS[1])]
+            for i in range(4):
+                firings[side] |= odd[i].astype(numpy.uint8) << (i*2)
+                firings[side] |= even[i].astype(numpy.uint8) << (i*2 + 1)
+
+        return firings
 
     def dilate(self, img):
         width, height = img.size
@@ -260,15 +1190,17 @@ class ImageProcessor:
         return outImg
 
     def writeCommands(self, progressFunc=None):
-        width, height = outputImages[0].size
+        width, height = self.outputImages[0].size
 
         # Ignore empty pixels added to the bottom of the file.
         height -= (int(208/self.mOffset) * self.mOffset)
 
         xposition = 0
+        yposition = 0
+        passes = int(height/self.mOffset)*2 + 1
 
-        tot = 25.0 / (int(height/self.mOffset)*2 + 1)
-        for y in xrange(int(height/self.mOffset)*2 + 1):
+        tot = 25.0 / passes
+        for y in xrange(passes):
             # Print out progress
             if progressFunc:
                 if not progressFunc(75 + (y + 1) * tot, 100):
@@ -278,10 +1210,18 @@ class ImageProcessor:
             else:
                 print('{} out of {}.'.format(y + 1, int(height/self.mOffset)*2 + 1))
 
-            yposition = 0
+            # Odd passes go right to left when printing both ways.
+            reverse = self.passReversed(y)
+            columns = xrange(width)
+            if reverse:
+                columns = xrange(width - 1, -1, -1)
+            backlash = 0
+            if self.chainsPasses():
+                backlash = self.BACKLASH[reverse]
+            first = True
 
             # Iterate through the width of the image(s)
-            for x in xrange(width):
+            for x in columns:
 
                 firings = [
                         [
@@ -294,7 +1234,25 @@ class ImageProcessor:
                 if not any([any(firings[i]) for i in xrange(len(firings))]):
                     continue
 
-                move = int((x + 1) * self.SPN) - yposition
+                # Catch up on line feeds held back from blank passes.
+                if self.MERGE_BLANK_PASSES and first:
+                    movex = int(self.mOffset * y * self.SPN) - xposition
+                    if movex != 0:
+                        self.writeMovementCommand('X', -movex)
+                        xposition += movex
+
+                position = int((x + 1) * self.SPN) + backlash
+                if first and self.chainsPasses():
+                    following = None
+                    step = -1 if reverse else 1
+                    for nx in xrange(x + step, -1 if reverse else width, step):
+                        if self.columnInked(nx, y):
+                            following = int((nx + 1) * self.SPN) + backlash
+                            break
+                    position = self.approach(position, yposition, reverse, following)
+                first = False
+
+                move = position - yposition
                 if move != 0:
                     yposition += move
                     self.writeMovementCommand('Y', move)
@@ -305,28 +1263,56 @@ class ImageProcessor:
                         if firings[a] != [0]:
                             self.writeFiringCommand(a, firings[a][0], firings[a][1])
 
-            # Carriage return
-            if yposition != 0:
+            # Carriage return, chained passes return at the end instead.
+            if yposition != 0 and not self.chainsPasses():
                 self.writeMovementCommand('Y', -yposition)
                 yposition = 0
 
             # Line feed
-            movex = int(self.mOffset * (y + 1) * self.SPN) - xposition
-            self.writeMovementCommand('X', -movex)
-            xposition += movex
+            if not self.MERGE_BLANK_PASSES:
+                movex = int(self.mOffset * (y + 1) * self.SPN) - xposition
+                self.writeMovementCommand('X', -movex)
+                xposition += movex
+
+        if yposition != 0:
+            self.writeMovementCommand('Y', -yposition)
+
+        # Line feeds held back since the last inked pass.
+        if self.MERGE_BLANK_PASSES:
+            movex = int(self.mOffset * passes * self.SPN) - xposition
+            if movex != 0:
+                self.writeMovementCommand('X', -movex)
 
         # Reset X and Y positions
         #self.writeMovementCommand('X', 0)
         #self.writeMovementCommand('Y', 0)
 
+        self.finishOutput()
+
+    def finishOutput(self):
         self.outputFile.close()
 
+        if self.compressor:
+            compressed = self.compressor.getvalue()
+            if compressed:
+                file = open(compressedPath(self.outputFileName), 'wb')
+                file.write(compressed.encode('utf-8'))
+                file.close()
+
+        if self.index:
+            compressed = self.compressor and not self.compressor.failed
+            self.index.save(self.outputFileName, compressed)
+
+    def columnInked(self, xPos, yPos):
+        # Whether any nozzle fires at column xPos of pass yPos.
+        for a in xrange(13):
+            if self.calculateFiring(xPos, yPos, a, 0) or self.calculateFiring(xPos, yPos, a, 1):
+                return True
+        return False
+
     def calculateFiring(self, xPos, yPos, addr, side):
         # Lookup tables to convert address to position
-        positions = (
-            (0, 10, 7, 4, 1, 11, 8, 5, 2, 12, 9, 6, 3),
-            (9, 6, 3, 0, 10, 7, 4, 1, 11, 8, 5, 2, 12)
-        )
+        positions = FIRING_POSITIONS
 
         # 13 nozzles in a primitive, these are the number of the nozzles, in the
         # correct firing order. The second grouping is for the even side? it is
@@ -353,7 +1339,7 @@ class ImageProcessor:
 
         for i in range(4):
             # if this pixel is on, set the corresponding bit in firing
-            if pixelMatrices[side*2][x, y][2] <= 200:
+            if self.pixelMatrices[side*2][x, y][2] <= 200:
                 firing += 1 << (i*2)
             y += 26
 
@@ -366,7 +1352,7 @@ class ImageProcessor:
 
         for i in range(4):
             # if this pixel is on, set the corresponding bit in firing
-            if pixelMatrices[side*2 + 1][x, y][2] <= 200:
+            if self.pixelMatrices[side*2 + 1][x, y][2] <= 200:
                 firing += 1 << (i*2 + 1)
             y += 26
 
@@ -376,8 +1362,7 @@ class ImageProcessor:
     Splits an input image into two images.
     '''
     def splitImageTwos(self, image):
-        width = image.width()
-        height = image.height()
+        width, height = image.size
 
         # If the height of the input image isn't a multiple of 4, round it up.
         if height % 4 != 0:
@@ -393,73 +1378,161 @@ class ImageProcessor:
         # References to the pixel data.
         evenMatrix = even.load()
         oddMatrix = odd.load()
-        inputVector = image.bits()
-        inputVector.setsize(image.byteCount())
-        stride = width*4
-
-        def inputMatrix(x, y):
-            return (ord(inputVector[x*4   + y*stride]),
-                    ord(inputVector[x*4+1 + y*stride]),
-                    ord(inputVector[x*4+2 + y*stride]),
-                    ord(inputVector[x*4+3 + y*stride]))
+        inputMatrix = image.load()
 
         # Divide by 4 because we're copying two rows at a time (why?)
         # Subtract 1 because of zero-offset.
         for y in xrange(int(height / 4) - 1):
             for x in xrange(width):
-                oddMatrix[x, y*2] = inputMatrix(x, y*4)
-                oddMatrix[x, y*2+1] = inputMatrix(x, y*4+1)
+                oddMatrix[x, y*2] = inputMatrix[x, y*4]
+                oddMatrix[x, y*2+1] = inputMatrix[x, y*4+1]
 
-                evenMatrix[x, y*2] = inputMatrix(x, y*4+2)
-                evenMatrix[x, y*2+1] = inputMatrix(x, y*4+3)
+                evenMatrix[x, y*2] = inputMatrix[x, y*4+2]
+                evenMatrix[x, y*2+1] = inputMatrix[x, y*4+3]
 
         # Handle the final row(s) specially
         # This shouldn't be necessary, since we know how many extras
         # (non-existant) we added.
         y = int(height / 4) - 1
         for x in xrange(width):
-            if y*4 < image.height(): oddMatrix[x, y*2] = inputMatrix(x, y*4)
-            if y*4 + 1 < image.height(): oddMatrix[x, y*2+1] = inputMatrix(x, y*4+1)
+            if y*4 < image.size[1]: oddMatrix[x, y*2] = inputMatrix[x, y*4]
+            if y*4 + 1 < image.size[1]: oddMatrix[x, y*2+1] = inputMatrix[x, y*4+1]
 
-            if y*4 + 2 < image.height(): evenMatrix[x, y*2] = inputMatrix(x, y*4+2)
-            if y*4 + 3 < image.height(): evenMatrix[x, y*2+1] = inputMatrix(x, y*4+3)
+            if y*4 + 2 < image.size[1]: evenMatrix[x, y*2] = inputMatrix[x, y*4+2]
+            if y*4 + 3 < image.size[1]: evenMatrix[x, y*2+1] = inputMatrix[x, y*4+3]
 
         return (odd, even)
 
     def writeMovementCommand(self, axis, steps):
-        self.outputFile.write('M {} {}\n'.format(axis, steps).encode('utf-8'))
+        self.outputFile.write(self.movementCommand(axis, steps))
+        if self.compressor:
+            self.compressor.movement(axis, steps)
+
+    def movementCommand(self, axis, steps):
+        command = MOVEMENT_COMMANDS.get((axis, steps))
+        if command is None:
+            command = 'M {} {}\n'.format(axis, steps).encode('utf-8')
+            if len(MOVEMENT_COMMANDS) < 100000:
+                MOVEMENT_COMMANDS[(axis, steps)] = command
+        return command
 
     def writeFiringCommand(self, a, firing1, firing2):
-        # The multiplexer doesn't use the first output, for startup reasons.
-        a = a + 1
-
-        address =  (a & 0b00000001) << 3
-        address += (a & 0b00000010) << 1
-        address += (a & 0b00000100) >> 1
-        address += (a & 0b00001000) >> 3
+        self.outputFile.write(self.firingCommand(a, firing1, firing2))
+        if self.compressor:
+            self.compressor.firing('{:01X}'.format(FIRING_ADDRESSES[a]),
+                                   '{:02X}{:02X}'.format(firing1, firing2))
 
-        #self.outputFile.write('F {} {} {}\n'.format(a, firing1, firing2))
+    def firingCommand(self, a, firing1, firing2):
+        address = FIRING_ADDRESSES[a]
 
+        #return 'F {} {} {}\n'.format(a, firing1, firing2)
 
         if self.USE_TEXTUAL_FIRING:
-            self.outputFile.write('F {:01X}{:02X}{:02X}\n'.format(address, firing1, firing2).encode('utf-8'))
+            return TEXTUAL_FIRING_PREFIXES[a] + HEX_BYTES[firing1] + HEX_BYTES[firing2] + b'\n'
         else:
-            outputStream = self.outputFile
-            outputStream.write(chr(1)) # Fire command
-            outputStream.write(chr(firing1)) # Relevant firing data, i.e. which primitive(s) to fire
-            outputStream.write(chr(address)) # The address we're firing within the primitive(s)
-            outputStream.write('\n')
-            outputStream.write(chr(1)) # Fire command
-            outputStream.write(chr(firing2)) # Relevant firing data, i.e. which primitive(s) to fire
-            outputStream.write(chr(address)) # The address we're firing within the primitive(s)
-            outputStream.write('\n')
+            return bytes(bytearray((
+                1, # Fire command
+                firing1, # Relevant firing data, i.e. which primitive(s) to fire
+                address, # The address we're firing within the primitive(s)
+                ord('\n'),
+                1, # Fire command
+                firing2, # Relevant firing data, i.e. which primitive(s) to fire
+                address, # The address we're firing within the primitive(s)
+                ord('\n')
+            )))
+
+def passCommandsWorker(processor, planes, passes):
+    # Runs in a worker process of ImageProcessor.poolPassCommands.
+    processor.planes = planes
+    return [processor.passCommands(y) for y in passes]
+
+'''
+A way of slicing, as the ImageProcessor options that choose it. They all make
+the same output. reference is the per pixel code, arrays needs numpy and
+processes also needs concurrent.futures and more than one core, it makes the
+passes in a process per core.
+'''
+class SliceEngine:
+    def __init__(self, name, **options):
+        self.name = name
+        self.options = options
+
+    def available(self):
+        if self.options.get('USE_ARRAYS') and numpy is None:
+            return False
+        if self.options.get('PROCESSES') == 0:
+            return ProcessPoolExecutor is not None and cpuCount() > 1
+        return True
+
+    def configure(self, processor):
+        for name, value in self.options.items():
+            if name == 'PROCESSES' and value == 0:
+                value = cpuCount()
+            setattr(processor, name, value)
+
+# PROCESSES of 0 is a process per core.
+SLICE_ENGINES = [
+    SliceEngine('reference', USE_ARRAYS=False, PROCESSES=1),
+    SliceEngine('arrays', USE_ARRAYS=True, PROCESSES=1),
+    SliceEngine('processes', USE_ARRAYS=True, PROCESSES=0),
+]
+
+# Starting the worker processes and sending them the planes takes longer than
+# they save on images smaller than this, about half the printable area.
+PROCESSES_MIN_PIXELS = 4000000
+
+def cpuCount():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def getSliceEngine(name):
+    for engine in SLICE_ENGINES:
+        if engine.name == name:
+            return engine
+    return None
+
+def selectSliceEngine(name='auto', pixels=0):
+    # The engine called name if it is available, otherwise the fastest one
+    # that is for an image of that many pixels.
+    engine = getSliceEngine(name)
+    if engine and engine.available():
+        return engine
+    if name != 'auto':
+        print("Slicing engine {} isn't available, choosing one.".format(name))
+    if pixels >= PROCESSES_MIN_PIXELS and getSliceEngine('processes').available():
+        return getSliceEngine('processes')
+    if getSliceEngine('arrays').available():
+        return getSliceEngine('arrays')
+    return getSliceEngine('reference')
+
+def parseOptions(args):
+    # name=value ImageProcessor options from a command line, values are
+    # Python literals or strings.
+    options = {}
+    for arg in args:
+        name, value = arg.split('=', 1)
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        options[name] = value
+    return options
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("usage: imageproc <image file> <hex file> [width height]")
+    args = sys.argv[1:]
+    engine = 'auto'
+    if len(args) > 1 and args[0] == '-e':
+        engine = args[1]
+        args = args[2:]
+    if len(args) not in (2, 4):
+        print("usage: imageproc [-e auto|{}] <image file> <hex file> [width height]".format(
+              '|'.join(e.name for e in SLICE_ENGINES)))
         sys.exit(1)
     size = None
-    if len(sys.argv) == 5:
-        size = (int(sys.argv[3]), int(sys.argv[4]))
+    if len(args) == 4:
+        size = (int(args[2]), int(args[3]))
     ip = ImageProcessor()
-    ip.sliceImage(sys.argv[1], sys.argv[2], size)
+    ip.ENGINE = engine
+    ip.sliceImage(args[0], args[1], size=size)
@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Timing and memory instrumentation for slicing, compressing, sending and
+printing. Work is timed by spans:
+
+    with instrument.span('send', file=filename) as span:
+        ...
+        span.set(bytes=size)
+
+When a span ends a record of it, its name, fields, how long it took and any
+stages reported with span.stage, goes to the sink. The sink is picked with a
+spec string, from the ARGENTUM_INSTRUMENT environment variable or by calling
+configure:
+
+    log          print a line for each span, the default
+    none         record nothing
+    jsonl:PATH   append each record as a line of JSON to the file at PATH
+
+With ARGENTUM_TRACE_MEMORY=1, or configure(traceMemory=True), the outermost
+span also records the peak memory allocated while it ran, using tracemalloc
+when the Python has it.
+'''
+
+import os
+import json
+import time
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+class LogSink:
+    def record(self, record):
+        line = "{} took {:.3f}s".format(record['span'], record['seconds'])
+        stages = record.get('stages')
+        if stages:
+            line += " (" + ", ".join("{} {:.3f}s".format(name, seconds)
+                                     for name, seconds in stages) + ")"
+        if 'peakMemory' in record:
+            line += " peak {:.1f}MB".format(record['peakMemory'] / 1e6)
+        if 'error' in record:
+            line += " failed with " + record['error']
+        print(line)
+
+class JsonlSink:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, record):
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+def makeSink(spec):
+    # The sink for a spec string, None for none.
+    spec = (spec or 'log').strip()
+    if spec == 'none':
+        return None
+    if spec == 'log':
+        return LogSink()
+    if spec.startswith('jsonl:'):
+        return JsonlSink(spec[len('jsonl:'):])
+    print("Unknown instrumentation sink '{}', using log.".format(spec))
+    return LogSink()
+
+sink = makeSink(os.environ.get('ARGENTUM_INSTRUMENT'))
+traceMemory = os.environ.get('ARGENTUM_TRACE_MEMORY', '') not in ('', '0')
+
+def configure(spec=None, traceMemory=None):
+    # Changes the sink and whether memory is traced, leaving either alone
+    # when it is None.
+    global sink
+    if spec != None:
+        sink = makeSink(spec)
+    if traceMemory != None:
+        globals()['traceMemory'] = bool(traceMemory)
+
+'''
+A piece of work being timed. Use it in a with statement, or call start and
+finish where the work doesn't fit in one block. The time taken is in seconds
+once it has finished.
+'''
+class Span:
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+        self.stages = []
+        self.seconds = None
+        self.startTime = None
+        self.tracing = False
+
+    def start(self):
+        if (traceMemory and sink and tracemalloc is not None and
+                not tracemalloc.is_tracing()):
+            tracemalloc.start()
+            self.tracing = True
+        self.startTime = time.time()
+        return self
+
+    def elapsed(self):
+        return time.time() - self.startTime
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def stage(self, name, seconds):
+        # Reports a part of the work and how long it took.
+        self.stages.append((name, seconds))
+
+    def finish(self, error=None):
+        if self.seconds != None:
+            return
+        self.seconds = self.elapsed()
+        record = {'span': self.name, 'time': self.startTime,
+                  'seconds': self.seconds}
+        record.update(self.fields)
+        if self.stages:
+            record['stages'] = self.stages
+        if self.tracing:
+            record['peakMemory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.tracing = False
+        if error != None:
+            record['error'] = error
+        if sink:
+            sink.record(record)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.finish(type.__name__ if type else None)
+        return False
+
+def span(name, **fields):
+    return Span(name, fields)
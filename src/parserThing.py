@@ -397,5 +397,6 @@ def splitImageTwos(image):
     return (odd, even)
 
 
-tempInitiate()
+if __name__ == '__main__':
+    tempInitiate()
 # main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import socket
+
+from PIL import Image
+from PyQt4.QtGui import QImage
+from PyQt4 import QtCore
+
+from imageproc import ImageProcessor, numpy
+from slicedaemon import SliceClient, SliceDaemonError, jobOptions
+
+'''
+ImageProcessor for the GUI, which slices QImages. Images are loaded, and
+scaled, with Qt, so anything the GUI can show can be printed, and the pixels
+are read straight from the memory of the QImage.
+'''
+class QtImageProcessor(ImageProcessor):
+    # The address of a slicedaemon to slice with, the path of its socket or
+    # on Windows its port, or None to slice here. Slices are done here when
+    # the daemon can't be reached or won't write the output.
+    DAEMON = None
+    # Seconds to wait for the daemon to say how a slice is going, before
+    # giving up on it and slicing here.
+    DAEMON_TIMEOUT = 60
+
+    def sliceImage(self, inputFileName, outputFileName, progressFunc=None, size=None):
+        if self.DAEMON and numpy is not None:
+            try:
+                return self.sliceWithDaemon(inputFileName, outputFileName, progressFunc, size)
+            except (socket.error, ValueError, SliceDaemonError) as e:
+                print("Slicing daemon failed, {}, slicing here.".format(e))
+        return ImageProcessor.sliceImage(self, inputFileName, outputFileName, progressFunc, size)
+
+    def sliceWithDaemon(self, inputFileName, outputFileName, progressFunc=None, size=None):
+        # The daemon is sent the red of each pixel, which is all it needs, as
+        # the image may not be a file it can read or may be scaled by Qt.
+        image = self.loadImage(inputFileName)
+        if size:
+            image = self.scaleImage(image, size)
+        width, height = self.imageSize(image)
+        data = numpy.ascontiguousarray(self.imagePixels(image)).tobytes()
+        self.pixelImage = None
+
+        client = SliceClient(self.DAEMON, self.DAEMON_TIMEOUT)
+        try:
+            output = client.slicePixels('L', width, height, data,
+                                        os.path.abspath(outputFileName),
+                                        jobOptions(self), progressFunc)
+        finally:
+            client.close()
+        if output and progressFunc:
+            progressFunc(100, 100)
+
+    def loadImage(self, inputFileName):
+        if type(inputFileName) == type(''):
+            return QImage(inputFileName)
+        return inputFileName
+
+    def imageSize(self, image):
+        return (image.width(), image.height())
+
+    def scaleImage(self, image, size):
+        width, height = size
+        return image.scaled(width, height, aspectRatioMode=QtCore.Qt.IgnoreAspectRatio, transformMode=QtCore.Qt.SmoothTransformation)
+
+    def imageData(self, image):
+        inputVector = image.bits()
+        inputVector.setsize(image.byteCount())
+        return ((image.width(), image.height(), image.format()), inputVector)
+
+    def argbImage(self, image):
+        if image.depth() != 32:
+            image = image.convertToFormat(QImage.Format_ARGB32)
+        return image
+
+    def imagePixels(self, image):
+        # The red of each pixel, byte 2 of the 32 bit pixels in memory, as a
+        # view. The job keeps the image, which owns the memory.
+        image = self.argbImage(image)
+        self.pixelImage = image
+        width = image.width()
+        height = image.height()
+
+        inputVector = image.bits()
+        inputVector.setsize(image.byteCount())
+        pixels = numpy.frombuffer(inputVector, dtype=numpy.uint8,
+                                  count=width*height*4)
+        return pixels.reshape(height, width, 4)[:, :, 2]
+
+    def transformedImage(self, image):
+        image = self.argbImage(image)
+        data = image.constBits().asstring(image.byteCount())
+        pilImage = Image.frombuffer('RGBA', (image.width(), image.height()),
+                                    data, 'raw', 'BGRA', 0, 1)
+        return ImageProcessor.transformedImage(self, pilImage)
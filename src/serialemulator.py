@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+'''
+An emulated printer that can stand in for the serial port of
+ArgentumPrinterController, to try file transfers without a printer. It
+greets like the firmware, stores the files it is sent with recv, by stop and
+wait or windowed transfer, and answers djb2 for them. Nothing is printed.
+
+The link is emulated in time: bytes take as long as they would at baud, the
+printer's answers take latency longer to come back, as through a USB serial
+adapter, and storing each block takes blockTime. Some blocks can be made bad,
+as if they were damaged on the way, by giving an errorRate.
+
+    serialemulator [-b baud] [-l latency] [-t blockTime] [-e errorRate] <file>
+
+sends the file to an emulated printer both ways and compares the times.
+'''
+
+import sys
+import time
+import random
+import collections
+
+from djb2 import calcDJB2
+
+BLOCK_SIZE = 1024
+
+class EmulatedPrinter(object):
+    timeout = None
+
+    def __init__(self, version="0.20.0+00000000", window=4, baud=115200,
+                 latency=0.016, blockTime=0.004, errorRate=0.0, seed=0):
+        self.version = version
+        self.window = window
+        self.byteTime = 10.0 / baud
+        self.latency = latency
+        self.blockTime = blockTime
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+
+        # When the link to the printer is next free and when the printer has
+        # stored the last block it was sent.
+        self.sending = 0.0
+        self.storing = 0.0
+        self.answering = 0.0
+        # (time, byte) of everything the printer has said, in order.
+        self.output = collections.deque()
+        self.input = bytearray()
+
+        self.files = {}
+        self.receiving = None
+
+        self.say(time.time(), "+Printer Number [EMU]\n+Version [{}]\n".format(version))
+
+    def windowed(self):
+        # Whether the emulated firmware takes windowed transfers, a window of
+        # 0 emulates firmware that doesn't.
+        return self.window > 0
+
+    def say(self, when, data):
+        if not isinstance(data, bytearray):
+            data = bytearray(data.encode('utf-8'))
+        # The adapter hands over all of an answer together, latency after
+        # the last of it is sent.
+        self.answering = max(when, self.answering) + len(data) * self.byteTime
+        for byte in data:
+            self.output.append((self.answering + self.latency, byte))
+
+    # The serial port.
+
+    def write(self, data):
+        data = bytearray(data)
+        self.sending = max(time.time(), self.sending) + len(data) * self.byteTime
+        self.input.extend(data)
+        self.process(self.sending)
+        return len(data)
+
+    def read(self, n):
+        deadline = None
+        if self.timeout != None:
+            deadline = time.time() + self.timeout
+        data = bytearray()
+        while len(data) < n:
+            now = time.time()
+            while self.output and self.output[0][0] <= now and len(data) < n:
+                data.append(self.output.popleft()[1])
+            if len(data) == n or not self.output:
+                break
+            until = self.output[0][0]
+            if deadline != None and until > deadline:
+                time.sleep(max(0, deadline - now))
+                break
+            time.sleep(until - now)
+        return bytes(data)
+
+    def inWaiting(self):
+        now = time.time()
+        return len([byte for when, byte in self.output if when <= now])
+
+    def flushInput(self):
+        now = time.time()
+        while self.output and self.output[0][0] <= now:
+            self.output.popleft()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    # The firmware.
+
+    def process(self, now):
+        while self.input:
+            if self.receiving == None:
+                end = self.input.find(b'\n')
+                if end == -1:
+                    return
+                line = self.input[:end].decode('utf-8', 'ignore').strip()
+                del self.input[:end + 1]
+                self.command(now, line.split())
+            elif self.control() == 'C':
+                del self.input[:1]
+                self.receiving = None
+            elif self.control() == 'P':
+                del self.input[:1]
+                self.say(now, 'p')
+            elif not self.receive(now):
+                return
+
+    def control(self):
+        # Cancel and pause come between blocks. Windowed frames start with a
+        # byte that has the top bit set, otherwise a block could start with C
+        # or P, but they are always sent on their own.
+        if self.receiving.windowed or len(self.input) == 1:
+            return chr(self.input[0])
+        return None
+
+    def command(self, now, words):
+        if len(words) in (3, 4) and words[0] == 'recv':
+            flags = words[2] if len(words) == 4 else ''
+            self.receiving = Transfer(words[-1], int(words[1]),
+                                      'w' in flags and self.windowed())
+            if self.receiving.windowed:
+                self.say(now, "Ready W {}\n".format(self.window))
+            else:
+                self.say(now, "Ready\n")
+        elif len(words) == 2 and words[0] == 'djb2' and words[1] in self.files:
+            self.say(now, "{:08x}\n".format(calcDJB2(self.files[words[1]])))
+
+    def receive(self, now):
+        # Takes one frame from the input if it is all there.
+        transfer = self.receiving
+        n = transfer.stored
+        offset = 0
+        if transfer.windowed:
+            sequence = self.input[0]
+            n = transfer.stored + ((sequence - transfer.stored) & 0x7f)
+            offset = 1
+        if transfer.windowed and n >= transfer.stored + self.window:
+            # Sent again after it was stored, its answer must have been lost.
+            n = n - 128
+            blocksize = min(BLOCK_SIZE, transfer.size - n * BLOCK_SIZE)
+            if len(self.input) < offset + blocksize + 5:
+                return False
+            self.say(now, bytearray(b'A') + self.input[:1])
+            del self.input[:offset + blocksize + 5]
+            return True
+        blocksize = min(BLOCK_SIZE, transfer.size - n * BLOCK_SIZE)
+        if len(self.input) < offset + blocksize + 5:
+            return False
+
+        block = bytes(self.input[offset:offset + blocksize])
+        trailer = bytearray(self.input[offset + blocksize:offset + blocksize + 5])
+        del self.input[:offset + blocksize + 5]
+
+        if transfer.windowed:
+            hash = calcDJB2(block)
+        else:
+            hash = calcDJB2(block, transfer.hash)
+        expected = bytearray([hash & 0x7f, (hash >> 7) & 0x7f, (hash >> 14) & 0x7f,
+                              (hash >> 21) & 0x7f, (hash >> 28) & 0x0f])
+        if trailer != expected or self.random.random() < self.errorRate:
+            if transfer.windowed:
+                self.say(now, bytearray([ord('N'), 0x80 | (n & 0x7f)]))
+            else:
+                self.say(now, 'B')
+            return True
+
+        if not transfer.windowed:
+            transfer.hash = hash
+            transfer.blocks[n] = block
+            self.store(now, transfer, 'G')
+        elif n not in transfer.blocks:
+            transfer.blocks[n] = block
+            self.store(now, transfer)
+        return True
+
+    def store(self, now, transfer, answer=None):
+        # Blocks are stored in order, each answered once it is stored.
+        while transfer.stored in transfer.blocks:
+            n = transfer.stored
+            transfer.data.extend(transfer.blocks.pop(n))
+            transfer.stored = n + 1
+            self.storing = max(now, self.storing) + self.blockTime
+            if transfer.windowed:
+                self.say(self.storing, bytearray([ord('A'), 0x80 | (n & 0x7f)]))
+            else:
+                self.say(self.storing, answer)
+        if len(transfer.data) == transfer.size:
+            self.files[transfer.name] = bytes(transfer.data)
+            self.receiving = None
+
+class Transfer(object):
+    def __init__(self, name, size, windowed):
+        self.name = name
+        self.size = size
+        self.windowed = windowed
+        self.hash = 5381
+        self.data = bytearray()
+        # Good blocks waiting for the ones before them, by block number.
+        self.blocks = {}
+        self.stored = 0
+
+def sendTo(printer, path, window):
+    # Sends the file at path to printer, returns the seconds it took.
+    from ArgentumPrinterController import ArgentumPrinterController
+    controller = ArgentumPrinterController()
+    controller.serialDevice = printer
+    controller.connected = True
+    controller.debug = lambda msg: None
+    controller.parseVersion(printer.version)
+    controller.WINDOW = window
+    # The greeting, which connect would have read.
+    printer.read(len(printer.output))
+    start = time.time()
+    if not controller.send(path):
+        return None
+    return time.time() - start
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    options = {}
+    names = {'-b': 'baud', '-l': 'latency', '-t': 'blockTime', '-e': 'errorRate'}
+    try:
+        while len(args) > 1 and args[0] in names:
+            options[names[args[0]]] = float(args[1])
+            del args[:2]
+        path, = args
+    except ValueError:
+        print("usage: serialemulator [-b baud] [-l latency] [-t blockTime] [-e errorRate] <file>")
+        sys.exit(1)
+
+    for name, window in (('stop and wait', 0), ('windowed', EmulatedPrinter().window)):
+        seconds = sendTo(EmulatedPrinter(**options), path, window)
+        if seconds == None:
+            print("{}: failed".format(name))
+        else:
+            print("{}: {:.2f}s".format(name, seconds))
@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+'''
+Benchmarks ImageProcessor on generated images and writes the results as JSON.
+
+Each run slices one workload, a pattern at a size in millimetres, with one
+dilateCount, and records how long each stage of the slice took, the total,
+the peak memory and the size of the hex file. Every slice is run in a fresh
+Python, so its peak resident set size (RSS) is its own and not what earlier
+slices left behind. The RSS includes the interpreter, the modules and the
+loaded image. When tracemalloc is available the peak of the Python heap
+while slicing, numpy's arrays included, is recorded too.
+Processor options can be given as name=value to compare slicing engines,
+for example ENGINE='reference' or STREAMING=True. Without ENGINE the arrays
+engine in one process is used, whatever the size of the image.
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import subprocess
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import numpy
+from PIL import Image
+
+from imageproc import ImageProcessor, parseOptions
+
+# Pixels per millimetre, the same as the print view.
+PIXELS_PER_MM = 23.70
+
+# Plate sizes in millimetres, up to the whole printable area.
+PLATE_SIZES = [(50, 30), (115, 60), (230, 120)]
+
+# Narrow and long images, in both orientations.
+TALL_SIZE = (30, 120)
+WIDE_SIZE = (230, 20)
+
+DILATE_COUNTS = [1, 3]
+
+# Only the smallest plate when run with -q.
+QUICK_PLATE_SIZES = PLATE_SIZES[:1]
+
+def blank(width, height):
+    return numpy.full((height, width, 4), 255, dtype=numpy.uint8)
+
+def solid(width, height):
+    # Ink everywhere, the most firings a plate can have.
+    pixels = blank(width, height)
+    pixels[:, :, 0:3] = 0
+    return pixels
+
+def traces(width, height):
+    # Tracks 8 pixels wide, most running one way and a few the other, with
+    # square pads between them. Mostly blank, like a typical board.
+    pixels = blank(width, height)
+    for offset in range(8):
+        pixels[offset::96, width // 10:width * 6 // 10, 0:3] = 0
+        pixels[:height // 3, offset::400, 0:3] = 0
+    for y in range(48, height, 240):
+        for x in range(width * 6 // 10, width, 240):
+            pixels[y:y + 30, x:x + 30, 0:3] = 0
+    return pixels
+
+def halftone(width, height):
+    # Random dots covering half the plate, nothing repeats from column to
+    # column.
+    pixels = blank(width, height)
+    random = numpy.random.RandomState(0)
+    pixels[random.random_sample((height, width)) < 0.5, 0:3] = 0
+    return pixels
+
+PATTERNS = {
+    'solid': solid,
+    'traces': traces,
+    'halftone': halftone,
+}
+
+def workloads(quick=False):
+    # (name, pattern, size in mm) of everything to slice.
+    sizes = QUICK_PLATE_SIZES if quick else PLATE_SIZES
+    for size in sizes:
+        for name in sorted(PATTERNS):
+            yield ('{}-{}x{}'.format(name, size[0], size[1]), name, size)
+    yield ('tall-{}x{}'.format(*TALL_SIZE), 'traces', TALL_SIZE)
+    yield ('wide-{}x{}'.format(*WIDE_SIZE), 'traces', WIDE_SIZE)
+
+def makeImage(pattern, size, directory):
+    # Writes the workload to a PNG file and returns its path.
+    width = int(size[0] * PIXELS_PER_MM)
+    height = int(size[1] * PIXELS_PER_MM)
+    path = os.path.join(directory, '{}-{}x{}.png'.format(pattern, width, height))
+    if not os.path.exists(path):
+        Image.fromarray(PATTERNS[pattern](width, height), 'RGBA').save(path)
+    return path
+
+def peakRSS(who):
+    # The peak RSS in bytes of this process, or of the largest of its
+    # children that have finished, None where that isn't known.
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes, except on macOS.
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+def sliceOnce(imagePath, outputPath, dilateCount, options):
+    # Run in the process started by sliceInProcess.
+    ip = ImageProcessor(dilateCount=dilateCount)
+    for name, value in options.items():
+        setattr(ip, name, value)
+    # Always a full slice, not a splice of the last run's output.
+    ip.INCREMENTAL = False
+
+    stages = {}
+    def stageFunc(name, seconds):
+        stages[name] = stages.get(name, 0) + seconds
+    ip.stageFunc = stageFunc
+
+    # Loading the PNG isn't part of slicing.
+    image = ip.loadImage(imagePath)
+
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        ip.sliceImage(image, outputPath)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    total = time.time() - start
+    peakHeap = None
+    if tracemalloc:
+        peakHeap = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return {
+        'stages': stages,
+        'total': total,
+        'peakRSS': peakRSS(resource.RUSAGE_SELF) if resource else None,
+        # The largest of the worker processes, when slicing with PROCESSES.
+        'workerPeakRSS': peakRSS(resource.RUSAGE_CHILDREN) if resource else None,
+        'peakHeap': peakHeap,
+        'hexBytes': os.path.getsize(outputPath),
+    }
+
+def sliceInProcess(imagePath, outputPath, dilateCount, options):
+    # Runs sliceOnce in a new Python and returns what it did.
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--slice',
+                                json.dumps([imagePath, outputPath, dilateCount, options])],
+                               stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise RuntimeError('slicing {} failed'.format(imagePath))
+    return json.loads(output.decode('utf-8'))
+
+def megabytes(size):
+    if size is None:
+        return '       -'
+    return '{:6.1f}MB'.format(size / 1e6)
+
+def run(quick=False, repeat=1, options=None, log=sys.stdout):
+    if options is None:
+        options = {}
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        for name, pattern, size in workloads(quick):
+            imagePath = makeImage(pattern, size, directory)
+            outputPath = os.path.join(directory, 'out.hex')
+            width, height = Image.open(imagePath).size
+            for dilateCount in DILATE_COUNTS:
+                # The fastest of repeat runs, peak memory is the same for all.
+                best = None
+                for i in range(repeat):
+                    result = sliceInProcess(imagePath, outputPath, dilateCount, options)
+                    if best is None or result['total'] < best['total']:
+                        best = result
+                best.update({
+                    'workload': name,
+                    'pattern': pattern,
+                    'width': width,
+                    'height': height,
+                    'dilateCount': dilateCount,
+                })
+                results.append(best)
+                log.write('{:<22} {:>5}x{:<5} dilate {}  {:8.3f}s  RSS {}  heap {}  {}\n'.format(
+                          name, width, height, dilateCount, best['total'],
+                          megabytes(best['peakRSS']), megabytes(best['peakHeap']),
+                          ' '.join('{} {:.3f}'.format(stage, seconds)
+                                   for stage, seconds in sorted(best['stages'].items()))))
+                log.flush()
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] == ['--slice']:
+        imagePath, outputPath, dilateCount, options = json.loads(args[1])
+        options = dict((name, tuple(value) if isinstance(value, list) else value)
+                       for name, value in options.items())
+        result = sliceOnce(imagePath, outputPath, dilateCount, options)
+        sys.stdout.write(json.dumps(result))
+        sys.exit(0)
+
+    quick = '-q' in args
+    if quick:
+        args.remove('-q')
+    outputFileName = 'slicebench.json'
+    repeat = 1
+    try:
+        if '-o' in args:
+            i = args.index('-o')
+            outputFileName = args[i + 1]
+            del args[i:i + 2]
+        if '-r' in args:
+            i = args.index('-r')
+            repeat = int(args[i + 1])
+            del args[i:i + 2]
+        options = parseOptions(args)
+    except (IndexError, ValueError):
+        print('usage: slicebench [-q] [-r repeat] [-o results.json] [option=value ...]')
+        sys.exit(1)
+
+    results = run(quick, repeat, options)
+    with open(outputFileName, 'w') as f:
+        json.dump({
+            'time': time.time(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'numpy': numpy.__version__,
+            'options': options,
+            'results': results,
+        }, f, indent=1)
+    print('Wrote {}.'.format(outputFileName))
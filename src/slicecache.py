@@ -0,0 +1,128 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import shutil
+
+from hexcompress import compressedPath
+from sliceindex import indexPath
+
+# How much disk the cache may use when no size is given, 1GB.
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+# The files the slicer writes next to a hex file, they are cached with it.
+SIDECARS = (compressedPath, indexPath)
+
+'''
+A directory of sliced hex files named by their slice key (see
+ImageProcessor.getSliceKey), which changes whenever the image or any setting
+that changes the output of the slicer does. So a hex file found here is always
+good to print and nothing ever has to expire by age.
+
+Entries are kept as copies, the hex files printed from are never the ones in
+the cache. Every use of an entry touches its modified time and once the
+entries add up to more than maxBytes the least recently used ones are removed.
+'''
+class SliceCache:
+    def __init__(self, directory, maxBytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.hex')
+
+    def fetch(self, key, path):
+        # Copies the hex file sliced with key, and the files that go with it,
+        # to path. Returns False when there's no such entry.
+        cached = self.path(key)
+        try:
+            os.utime(cached, None)
+        except OSError:
+            return False
+
+        shutil.copyfile(cached, path)
+        # The other files have to be copied after the hex file, so that they
+        # aren't older than it.
+        for sidecar in SIDECARS:
+            if os.path.exists(sidecar(cached)):
+                shutil.copyfile(sidecar(cached), sidecar(path))
+            elif os.path.exists(sidecar(path)):
+                os.remove(sidecar(path))
+        return True
+
+    def store(self, key, path):
+        # Adds the hex file at path, just sliced with key, to the cache.
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        cached = self.path(key)
+        for sidecar in SIDECARS:
+            if os.path.exists(sidecar(path)):
+                self.copy(sidecar(path), sidecar(cached))
+            elif os.path.exists(sidecar(cached)):
+                os.remove(sidecar(cached))
+        self.copy(path, cached)
+
+        self.evict()
+
+    def copy(self, source, destination):
+        # Copy under another name first and rename it into place, so a copy
+        # that didn't finish is never taken for an entry.
+        temporary = destination + '.tmp'
+        shutil.copyfile(source, temporary)
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(temporary, destination)
+
+    def entries(self):
+        # Returns (last used, size in bytes, path) for every entry.
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.hex'):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                size = os.path.getsize(path)
+                for sidecar in SIDECARS:
+                    if os.path.exists(sidecar(path)):
+                        size += os.path.getsize(sidecar(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.maxBytes:
+                break
+            print("Removing {} from the slice cache.".format(os.path.basename(path)))
+            os.remove(path)
+            for sidecar in SIDECARS:
+                if os.path.exists(sidecar(path)):
+                    os.remove(sidecar(path))
+            total -= size
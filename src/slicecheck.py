@@ -0,0 +1,527 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+'''
+Checks that the slicer engines all fire the same nozzles for the same images.
+
+Every available engine slices every image of a corpus with every parameter
+set, and the hex files are compared firing by firing against the first
+engine's, or against golden hex files recorded earlier. Moves are only
+followed to know where the head is, so engines that get around differently,
+like bidirectional printing or merged line feeds, still compare equal when
+they fire the same nozzles at the same pass and column. When they don't, the
+first pass, column and address that differ is reported. Where the slicer
+writes a compressed file along with the hex file, it has to be what
+compressing the hex file line by line makes.
+
+The engines are ImageProcessor with each way it can slice, and the legacy
+imageparser.py and parserThing.py scripts, which are run with Python 2 when
+there is one with PIL (set ARGENTUM_PYTHON2 to its path if it isn't called
+python2). The legacy scripts don't dilate, don't mirror and rotate the image
+and skip the addresses of a column that don't fire, so they are only checked
+with parameter sets that don't dilate, are given the image already turned,
+and blank firings are left out when comparing with them. They also read the
+blue of each pixel where ImageProcessor reads the red, so the corpus is grey.
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import contextlib
+
+import numpy
+from PIL import Image
+
+import imageproc
+from imageproc import ImageProcessor, FIRING_ADDRESSES
+from hexcompress import HexCompressor, compressedPath
+
+# Parameter sets, as ImageProcessor attributes.
+PARAMETER_SETS = [
+    ('default', {}),
+    ('gui', {'HEADOFFSET': 726, 'mOffset': 41}),
+    ('undilated', {'HEADOFFSET': 726, 'VOFFSET': -2, 'mOffset': 41, 'dilateCount': 0}),
+    ('narrow', {'HEADOFFSET': 60, 'mOffset': 27, 'dilateCount': 0, 'fps': 2}),
+    ('backlash', {'BIDIRECTIONAL': True, 'BACKLASH': (2, 5), 'WRITE_COMPRESSED': True}),
+]
+
+def blank(width, height):
+    return numpy.full((height, width, 4), 255, dtype=numpy.uint8)
+
+def solid(width, height):
+    pixels = blank(width, height)
+    pixels[:, :, 0:3] = 0
+    return pixels
+
+def traces(width, height):
+    # Tracks and pads, with a grey that is just dark enough to print.
+    pixels = blank(width, height)
+    for offset in range(6):
+        pixels[offset::40, width // 8:width * 5 // 8, 0:3] = 0
+        pixels[:height // 2, offset::70, 0:3] = 200
+    for y in range(20, height, 60):
+        for x in range(width * 5 // 8, width, 50):
+            pixels[y:y + 12, x:x + 12, 0:3] = 0
+    return pixels
+
+def halftone(width, height):
+    # Random dots, in greys either side of where printing starts.
+    pixels = blank(width, height)
+    random = numpy.random.RandomState(1)
+    grey = random.randint(150, 256, (height, width)).astype(numpy.uint8)
+    pixels[:, :, 0:3] = grey[:, :, None]
+    return pixels
+
+def corners(width, height):
+    # Single pixels in the corners and along the edges.
+    pixels = blank(width, height)
+    for y in (0, 1, height // 2, height - 2, height - 1):
+        for x in (0, 1, width // 2, width - 2, width - 1):
+            pixels[y, x, 0:3] = 0
+    return pixels
+
+# Images as (name, pattern, width, height) in pixels. Heights that aren't a
+# multiple of 4 check the padding of the split.
+CORPUS = [
+    ('blank', blank, 40, 30),
+    ('solid', solid, 90, 61),
+    ('traces', traces, 300, 200),
+    ('halftone', halftone, 150, 103),
+    ('corners', corners, 77, 142),
+]
+
+@contextlib.contextmanager
+def quiet():
+    # What the slicer prints goes nowhere. contextlib.redirect_stdout would
+    # do, but Python 2 doesn't have it.
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+'''
+One way of slicing, ImageProcessor with options set or a legacy script.
+'''
+class Engine:
+    # Column c is fired at int((c + columnOffset) * SPN) along columnAxis.
+    columnAxis = 'Y'
+    columnOffset = 1
+    # Whether addresses of a column that don't fire are left out.
+    skipsBlankAddresses = False
+
+    def __init__(self, name, options=None):
+        self.name = name
+        self.options = options or {}
+
+    def available(self):
+        if self.options.get('USE_ARRAYS', True) and imageproc.numpy is None:
+            return False
+        if self.options.get('PROCESSES', 1) > 1 and imageproc.ProcessPoolExecutor is None:
+            return False
+        return True
+
+    def supports(self, parameters):
+        return True
+
+    def processor(self, parameters):
+        ip = ImageProcessor()
+        for name, value in list(parameters.items()) + list(self.options.items()):
+            setattr(ip, name, value)
+        return ip
+
+    def slice(self, imagePath, outputPath, parameters):
+        ip = self.processor(parameters)
+        ip.INCREMENTAL = False
+        with quiet():
+            ip.sliceImage(imagePath, outputPath)
+
+'''
+Slices an edited copy of the image and then the image to the same file, the
+second slice copying the passes that the edit didn't change from the first.
+'''
+class IncrementalEngine(Engine):
+    def available(self):
+        return imageproc.numpy is not None
+
+    def slice(self, imagePath, outputPath, parameters):
+        ip = self.processor(parameters)
+        ip.INCREMENTAL = True
+        for path in (outputPath, outputPath + 'i'):
+            if os.path.exists(path):
+                os.remove(path)
+
+        # A band down the middle of the image inverted, which the slicer
+        # turns into a band of passes.
+        pixels = numpy.array(Image.open(imagePath).convert('RGBA'))
+        width = pixels.shape[1]
+        pixels[:, width // 3:width // 2, 0:3] ^= 255
+        editedPath = outputPath + '.png'
+        Image.fromarray(pixels, 'RGBA').save(editedPath)
+        try:
+            with quiet():
+                ip.sliceImage(editedPath, outputPath)
+                ip.sliceImage(imagePath, outputPath)
+        finally:
+            os.remove(editedPath)
+
+# Run by Python 2 to slice with a legacy script: source directory, module,
+# image, output file and parameters as JSON.
+LEGACY_DRIVER = '''
+import os, sys, json
+source, name, imagePath, outputPath, parameters = sys.argv[1:6]
+sys.path.insert(0, source)
+sys.stdout = open(os.devnull, 'w')
+from PIL import Image
+# The scripts save the images they make along the way, which newer PILs
+# can't do for the RGBA JPEGs, and they aren't wanted here anyway.
+Image.Image.save = lambda self, *args, **kwargs: None
+engine = __import__(name)
+for key, value in json.loads(parameters).items():
+    setattr(engine, str(key), value)
+image = Image.open(imagePath).convert('RGBA')
+os.chdir(os.path.dirname(outputPath))
+if name == 'imageparser':
+    engine.outputFile = outputPath
+    engine.sliceImage('.', image)
+else:
+    engine.sliceImage(open(outputPath, 'wb'), image)
+'''
+
+# The ImageProcessor attributes the legacy scripts have as globals.
+LEGACY_PARAMETERS = ('HEADOFFSET', 'PRIMITIVEOFFSET', 'VOFFSET', 'SPN', 'mOffset', 'fps')
+
+class LegacyEngine(Engine):
+    columnAxis = 'X'
+    columnOffset = 0
+    skipsBlankAddresses = True
+
+    def __init__(self, name, module):
+        Engine.__init__(self, name)
+        self.module = module
+
+    def python(self):
+        return os.environ.get('ARGENTUM_PYTHON2', 'python2')
+
+    def available(self):
+        try:
+            return subprocess.call([self.python(), '-c', 'import PIL, Tkinter'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
+        except OSError:
+            return False
+
+    def supports(self, parameters):
+        return self.processor(parameters).dilateCount == 0
+
+    def slice(self, imagePath, outputPath, parameters):
+        ip = self.processor(parameters)
+        legacyParameters = dict((name, getattr(ip, name)) for name in LEGACY_PARAMETERS)
+
+        # The legacy scripts slice the image the way it is, ImageProcessor
+        # mirrors it and turns it a quarter clockwise first.
+        pixels = numpy.asarray(Image.open(imagePath).convert('RGBA'))
+        turnedPath = outputPath + '.png'
+        Image.fromarray(numpy.ascontiguousarray(pixels[::-1, ::-1].transpose(1, 0, 2)),
+                        'RGBA').save(turnedPath)
+        try:
+            process = subprocess.Popen([self.python(), '-c', LEGACY_DRIVER,
+                                        os.path.dirname(os.path.abspath(__file__)),
+                                        self.module, turnedPath,
+                                        os.path.abspath(outputPath),
+                                        json.dumps(legacyParameters)],
+                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            errors = process.communicate()[1].decode('utf-8', 'replace').strip()
+            if process.returncode != 0:
+                raise RuntimeError(errors.split('\n')[-1])
+        finally:
+            os.remove(turnedPath)
+
+ENGINES = [
+    Engine('reference', {'USE_ARRAYS': False}),
+    Engine('auto', {'ENGINE': 'auto'}),
+    Engine('arrays'),
+    Engine('streaming', {'STREAMING': True, 'STREAM_ROWS': 64}),
+    Engine('processes', {'PROCESSES': 2, 'PASS_CHUNK': 3}),
+    Engine('binary', {'USE_TEXTUAL_FIRING': False}),
+    Engine('unmerged', {'MERGE_BLANK_PASSES': False}),
+    Engine('bidirectional', {'BIDIRECTIONAL': True}),
+    Engine('trimTravel', {'TRIM_TRAVEL': True}),
+    IncrementalEngine('incremental'),
+    LegacyEngine('imageparser', 'imageparser'),
+    LegacyEngine('parserThing', 'parserThing'),
+]
+
+def readCommands(path):
+    # Yields ('M', axis, steps) and ('F', address, firing1, firing2) for the
+    # commands of the hex file at path, in any of the formats.
+    with open(path, 'rb') as f:
+        data = f.read()
+    pending = None
+    i = 0
+    while i < len(data):
+        if data[i:i + 1] == b'\x01':
+            # Binary firings, one side at a time, the second with the same
+            # address completes the command.
+            firing, address = bytearray(data[i + 1:i + 3])
+            i += 4
+            if pending and pending[0] == address:
+                yield ('F', address, pending[1], firing)
+                pending = None
+            else:
+                pending = (address, firing)
+            continue
+        end = data.find(b'\n', i)
+        if end == -1:
+            end = len(data)
+        line = data[i:end].decode('ascii', 'replace')
+        i = end + 1
+        if line.startswith('M '):
+            yield ('M', line[2], int(line[4:]))
+        elif line.startswith('F '):
+            yield ('F', int(line[2], 16), int(line[3:5], 16), int(line[5:7], 16))
+
+def readFirings(path, engine, processor):
+    # The firings of the hex file at path as (pass, column, address,
+    # firing1, firing2) in the order they are on the plate. Passes and
+    # columns are None where the head isn't at one, with the steps instead.
+    passAxis = 'X' if engine.columnAxis == 'Y' else 'Y'
+    SPN = processor.SPN
+    passes = {}
+    for y in range(100000):
+        position = int(processor.mOffset * y * SPN)
+        passes[-position] = y
+        if position > 10000000:
+            break
+
+    position = {'X': 0, 'Y': 0}
+    firings = []
+    for command in readCommands(path):
+        if command[0] == 'M':
+            axis, steps = command[1:]
+            if steps == 0:
+                # The legacy scripts move home with a move of 0.
+                position[axis] = 0
+            else:
+                position[axis] += steps
+            continue
+        address, firing1, firing2 = command[1:]
+        steps = position[engine.columnAxis]
+        column = int(round(steps / SPN)) - engine.columnOffset
+        if int((column + engine.columnOffset) * SPN) != steps:
+            column = None
+        firings.append((passes.get(position[passAxis]), column,
+                        FIRING_ADDRESSES.index(address), firing1, firing2,
+                        position[passAxis], steps))
+
+    # Engines may go through the passes and columns in any order, the order
+    # of the firings of each column is kept.
+    firings.sort(key=lambda firing: (-firing[5], firing[6]))
+    return firings
+
+def describe(firing):
+    if firing is None:
+        return 'nothing'
+    y, column, address, firing1, firing2, passSteps, steps = firing
+    return 'pass {}, column {}, address {}: {:02X}{:02X}'.format(
+        y if y is not None else '({} steps)'.format(passSteps),
+        column if column is not None else '({} steps)'.format(steps),
+        address, firing1, firing2)
+
+def compare(expected, actual, skipBlank):
+    # Returns None if the firings are the same, otherwise a description of
+    # the first that differs.
+    if skipBlank:
+        expected = [f for f in expected if f[3] or f[4]]
+        actual = [f for f in actual if f[3] or f[4]]
+    for i in range(max(len(expected), len(actual))):
+        a = expected[i] if i < len(expected) else None
+        b = actual[i] if i < len(actual) else None
+        if a is None or b is None or a[:5] != b[:5]:
+            return 'firing {} differs, expected {}, got {}'.format(i, describe(a), describe(b))
+    return None
+
+def compareCompressed(path):
+    # Returns None if the compressed file the slicer wrote along with the hex
+    # file at path is what compressing the hex file makes, or there is
+    # neither, otherwise a description of the first line that differs.
+    compressor = HexCompressor()
+    with open(path, 'rb') as f:
+        for line in f.read().decode('ascii', 'replace').split('\n'):
+            if not compressor.line(line):
+                break
+    expected = compressor.getvalue()
+    actual = None
+    if os.path.exists(compressedPath(path)):
+        with open(compressedPath(path), 'rb') as f:
+            actual = f.read().decode('utf-8')
+    if expected == actual:
+        return None
+    if expected is None or actual is None:
+        return 'compressed file {}'.format('not written' if actual is None else 'written, '
+                                          'the hex file does not compress')
+    expected = expected.split('\n')
+    actual = actual.split('\n')
+    for i in range(max(len(expected), len(actual))):
+        a = expected[i] if i < len(expected) else None
+        b = actual[i] if i < len(actual) else None
+        if a != b:
+            return 'compressed line {} differs, expected {!r}, got {!r}'.format(i, a, b)
+
+def makeCorpus(directory, names=None):
+    # Writes the corpus images to directory, returns [(name, path)].
+    images = []
+    for name, pattern, width, height in CORPUS:
+        if names and name not in names:
+            continue
+        path = os.path.join(directory, name + '.png')
+        Image.fromarray(pattern(width, height), 'RGBA').save(path)
+        images.append((name, path))
+    return images
+
+def run(images, engines=None, parameterSets=None, golden=None, record=False, log=sys.stdout):
+    # Slices images, [(name, path)], with the engines named by engines and
+    # the parameter sets named by parameterSets, all of them by default.
+    # Returns the number of slices that didn't match.
+    engines = [e for e in ENGINES if not engines or e.name in engines]
+    unavailable = [e.name for e in engines if not e.available()]
+    if unavailable:
+        log.write('Not available: {}\n'.format(', '.join(unavailable)))
+    engines = [e for e in engines if e.name not in unavailable]
+
+    failures = 0
+    directory = tempfile.mkdtemp()
+    try:
+        for setName, parameters in PARAMETER_SETS:
+            if parameterSets and setName not in parameterSets:
+                continue
+            for imageName, imagePath in images:
+                expected = None
+                expectedPath = None
+                expectedEngine = None
+                if golden:
+                    path = os.path.join(golden, '{}-{}.hex'.format(imageName, setName))
+                    if os.path.exists(path) and not record:
+                        expectedPath = path
+                        expectedEngine = Engine('golden')
+                for engine in engines:
+                    if not engine.supports(parameters):
+                        continue
+                    label = '{}/{} {}'.format(imageName, setName, engine.name)
+                    outputPath = os.path.join(directory, '{}-{}-{}.hex'.format(
+                                              imageName, setName, engine.name))
+                    try:
+                        engine.slice(imagePath, outputPath, parameters)
+                    except Exception as e:
+                        failures += 1
+                        log.write('{}: failed, {}\n'.format(label, e))
+                        continue
+
+                    processor = engine.processor(parameters)
+                    # Only hex files of textual firings, one a column, are
+                    # compressed by the slicer.
+                    if processor.WRITE_COMPRESSED and processor.USE_TEXTUAL_FIRING and \
+                            processor.fps == 1:
+                        difference = compareCompressed(outputPath)
+                        if difference:
+                            failures += 1
+                            log.write('{}: {}\n'.format(label, difference))
+                            continue
+
+                    if expectedPath is None:
+                        # The first engine to slice is what the rest have
+                        # to match.
+                        expectedPath = outputPath
+                        expectedEngine = engine
+                        if golden and record:
+                            if not os.path.exists(golden):
+                                os.makedirs(golden)
+                            shutil.copyfile(outputPath, os.path.join(
+                                golden, '{}-{}.hex'.format(imageName, setName)))
+                        log.write('{}: {}\n'.format(label, 'recorded' if record else 'expected'))
+                        continue
+
+                    if expected is None:
+                        expected = readFirings(expectedPath, expectedEngine, processor)
+                    difference = compare(expected, readFirings(outputPath, engine, processor),
+                                         engine.skipsBlankAddresses or
+                                         expectedEngine.skipsBlankAddresses)
+                    if difference:
+                        failures += 1
+                        log.write('{}: {}\n'.format(label, difference))
+                    else:
+                        with open(expectedPath, 'rb') as a, open(outputPath, 'rb') as b:
+                            same = a.read() == b.read()
+                        log.write('{}: {}\n'.format(label, 'identical' if same else 'same firings'))
+                    log.flush()
+    finally:
+        shutil.rmtree(directory)
+    return failures
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    engines = None
+    parameterSets = None
+    golden = None
+    record = '-w' in args
+    if record:
+        args.remove('-w')
+    try:
+        for option in ('-e', '-p', '-g'):
+            if option in args:
+                i = args.index(option)
+                value = args[i + 1]
+                del args[i:i + 2]
+                if option == '-e':
+                    engines = value.split(',')
+                elif option == '-p':
+                    parameterSets = value.split(',')
+                else:
+                    golden = value
+        if record and not golden:
+            raise ValueError()
+        if [arg for arg in args if arg.startswith('-')]:
+            raise ValueError()
+    except (IndexError, ValueError):
+        print('usage: slicecheck [-e engine,...] [-p parameters,...] [-g golden directory [-w]] [image ...]')
+        sys.exit(1)
+
+    directory = tempfile.mkdtemp()
+    try:
+        if args:
+            images = [(os.path.splitext(os.path.basename(path))[0], path) for path in args]
+        else:
+            images = makeCorpus(directory)
+        failures = run(images, engines, parameterSets, golden, record)
+    finally:
+        shutil.rmtree(directory)
+    if failures:
+        print('{} slices failed or differ.'.format(failures))
+        sys.exit(1)
+    print('All the same.')
@@ -0,0 +1,532 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+'''
+A slicing service, so that slicing an image doesn't pay for starting Python
+and importing the slicer every time. The daemon listens on a Unix socket
+that only its user can connect to, or on Windows on a TCP port of the
+loopback interface, and slices the jobs it is sent in worker processes that
+stay up between jobs, any number of clients at a time. It only writes hex
+files inside its output directory.
+
+A request is a line of JSON, followed by dataLength bytes when it has them:
+
+    {"image": path, "output": path, "options": {...}, "size": [w, h]}
+        Slices the image file at path to the hex file output, a path in the
+        daemon's output directory. options are ImageProcessor
+        settings (see JOB_OPTIONS) and size, if given, scales the image first.
+    {"data": {"mode": "L", "width": w, "height": h}, "dataLength": n, ...}
+        The same with the pixels of the image sent raw instead, as a PIL
+        image of that mode and size. output is needed.
+    {"command": "ping"} and {"command": "stop"}
+
+and the response a line of JSON, {"ok": true, "output": path, "seconds": s}
+or {"ok": false, "error": message}. While a slice runs the daemon sends
+{"progress": [done, total]} lines before the response, and the client can
+send {"command": "cancel"}, or close the connection, to stop the slice. The
+response to a canceled slice has "canceled": true.
+
+The workers each slice one image at a time, in one process, as the jobs are
+what run in parallel. Jobs to the same output file wait for each other.
+'''
+
+import os
+import sys
+import json
+import stat
+import time
+import socket
+import select
+import threading
+import multiprocessing
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Without Unix sockets, on Windows, the daemon listens on a port of the
+# loopback interface and nowhere else.
+UNIX_SOCKETS = hasattr(socket, 'AF_UNIX')
+LOOPBACK = '127.0.0.1'
+DEFAULT_PORT = 5417
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.argentum', 'slicedaemon.sock')
+
+# Where hex files are written unless the daemon is given a directory, the
+# GUI's files directory.
+DEFAULT_OUTPUT_DIRECTORY = os.path.join(os.path.expanduser('~'), 'Documents', 'Argentum')
+
+# The ImageProcessor settings a job can give.
+JOB_OPTIONS = ('HEADOFFSET', 'PRIMITIVEOFFSET', 'VOFFSET', 'SPN', 'mOffset',
+               'dilateCount', 'fps', 'USE_TEXTUAL_FIRING', 'WRITE_COMPRESSED',
+               'MERGE_BLANK_PASSES', 'BIDIRECTIONAL', 'TRIM_TRAVEL', 'BACKLASH',
+               'INCREMENTAL', 'STREAMING', 'ENGINE')
+
+class SliceDaemonError(Exception):
+    pass
+
+def parseAddress(address):
+    # The path of the daemon's socket, or on Windows (LOOPBACK, port), from
+    # a path or port or None for the default.
+    if UNIX_SOCKETS:
+        return str(address) if address else DEFAULT_SOCKET
+    if not address:
+        return (LOOPBACK, DEFAULT_PORT)
+    return (LOOPBACK, int(address))
+
+def connect(address=None, timeout=None):
+    address = parseAddress(address)
+    if not UNIX_SOCKETS:
+        return socket.create_connection(address, timeout)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(address)
+    except socket.error:
+        connection.close()
+        raise
+    return connection
+
+def outputPath(directory, output):
+    # The absolute path of output in directory, relative paths are taken to
+    # be in it. Paths outside of it aren't allowed.
+    directory = os.path.join(os.path.realpath(directory), '')
+    path = os.path.realpath(os.path.join(directory, output))
+    if not path.startswith(directory):
+        raise SliceDaemonError("output {} isn't in {}".format(output, directory[:-1]))
+    return path
+
+def jobOptions(processor):
+    # The JOB_OPTIONS of an ImageProcessor, to slice the way it would.
+    options = {}
+    for name in JOB_OPTIONS:
+        value = getattr(processor, name)
+        if isinstance(value, tuple):
+            value = list(value)
+        options[name] = value
+    return options
+
+def readLine(stream):
+    line = stream.readline()
+    if not line:
+        return None
+    return json.loads(line.decode('utf-8'))
+
+def writeLine(stream, message):
+    stream.write((json.dumps(message) + '\n').encode('utf-8'))
+    stream.flush()
+
+def sliceJob(job, data=None, progress=None, cancel=None):
+    # Runs in a worker, returns the seconds the slice took. The progress of
+    # the slice is put on the progress queue, in whole percents, and it stops
+    # once cancel is set.
+    import imageproc
+    from PIL import Image
+
+    if progress is not None:
+        percents = [None]
+        def progressFunc(done, total):
+            percent = int(100 * done / total) if total else 0
+            if percent == percents[0]:
+                return True
+            percents[0] = percent
+            progress.put((done, total))
+            return not cancel.is_set()
+    else:
+        progressFunc = None
+
+    start = time.time()
+    ip = imageproc.ImageProcessor()
+    for name, value in job.get('options', {}).items():
+        if name not in JOB_OPTIONS:
+            raise SliceDaemonError("unknown option {}".format(name))
+        if isinstance(value, list):
+            value = tuple(value)
+        setattr(ip, name, value)
+    # Workers can't start processes of their own, the jobs are what run in
+    # parallel here.
+    if ip.ENGINE in ('auto', 'processes'):
+        ip.ENGINE = 'arrays'
+
+    image = job.get('image')
+    if data is not None:
+        info = job['data']
+        image = Image.frombuffer(info['mode'], (info['width'], info['height']),
+                                 data, 'raw', info['mode'], 0, 1)
+    size = job.get('size')
+    ip.sliceImage(image, job['output'], progressFunc, tuple(size) if size else None)
+    return time.time() - start
+
+def warm():
+    # Imports the slicer in a worker before the first job needs it, returns
+    # the worker's process ID.
+    __import__('imageproc')
+    return os.getpid()
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = readLine(self.rfile)
+            except ValueError:
+                writeLine(self.wfile, {'ok': False, 'error': 'bad request'})
+                return
+            if request is None:
+                return
+            response = self.server.sliceDaemon.handle(request, self)
+            if response is not None:
+                try:
+                    writeLine(self.wfile, response)
+                except socket.error:
+                    # The client went away, maybe canceling a slice.
+                    return
+
+'''
+A slice run on a thread of its own, the parts of a concurrent.futures Future
+that SliceDaemon uses, for when there's no concurrent.futures.
+'''
+class ThreadJob(threading.Thread):
+    def __init__(self, function, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.function = function
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.function(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def done(self):
+        return not self.is_alive()
+
+    def result(self):
+        self.join()
+        if self.error:
+            raise self.error
+        return self.value
+
+class SliceServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+if UNIX_SOCKETS:
+    class UnixSliceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            # A socket left by a daemon that didn't stop cleanly is replaced.
+            # It is created with only the user allowed to connect.
+            directory = os.path.dirname(self.server_address)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            if os.path.exists(self.server_address):
+                if not stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                    raise SliceDaemonError("{} isn't a socket".format(self.server_address))
+                os.remove(self.server_address)
+            umask = os.umask(0o177)
+            try:
+                socketserver.UnixStreamServer.server_bind(self)
+            finally:
+                os.umask(umask)
+            os.chmod(self.server_address, 0o600)
+
+        def server_close(self):
+            socketserver.UnixStreamServer.server_close(self)
+            if os.path.exists(self.server_address):
+                os.remove(self.server_address)
+
+'''
+The daemon, slicing the jobs its server threads are sent in workers
+processes, or in the server threads themselves when there's no
+concurrent.futures.
+'''
+class SliceDaemon:
+    def __init__(self, address=None, workers=None, directory=None):
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+        except ImportError:
+            ProcessPoolExecutor = None
+        import imageproc
+
+        if workers is None:
+            workers = imageproc.cpuCount()
+        self.workers = workers
+        self.executor = None
+        if ProcessPoolExecutor is not None:
+            # Progress and cancels go between the workers and the server
+            # threads through the manager's queues and events.
+            self.manager = multiprocessing.Manager()
+            self.executor = ProcessPoolExecutor(workers)
+            for future in [self.executor.submit(warm) for i in range(workers)]:
+                future.result()
+
+        self.lock = threading.Lock()
+        self.outputs = {}
+        self.jobs = 0
+
+        self.directory = directory or DEFAULT_OUTPUT_DIRECTORY
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        if UNIX_SOCKETS:
+            self.server = UnixSliceServer(parseAddress(address), JobHandler)
+        else:
+            self.server = SliceServer(parseAddress(address), JobHandler)
+        self.server.sliceDaemon = self
+
+    def address(self):
+        if UNIX_SOCKETS:
+            return self.server.server_address
+        return self.server.server_address[1]
+
+    def serve(self):
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if self.executor:
+                self.executor.shutdown()
+                self.manager.shutdown()
+
+    def stop(self):
+        # serve_forever waits for shutdown, so it can't be called from a
+        # request of the server being shut down.
+        threading.Thread(target=self.server.shutdown).start()
+
+    def outputLock(self, output):
+        with self.lock:
+            if output not in self.outputs:
+                self.outputs[output] = threading.Lock()
+            return self.outputs[output]
+
+    def handle(self, request, handler):
+        # The response to request, from the connection of handler.
+        stream = handler.rfile
+        command = request.get('command')
+        if command == 'ping':
+            return {'ok': True, 'workers': self.workers, 'jobs': self.jobs}
+        if command == 'stop':
+            self.stop()
+            return {'ok': True}
+        # A cancel that came after its slice was done.
+        if command == 'cancel':
+            return None
+        if command:
+            return {'ok': False, 'error': 'unknown command {}'.format(command)}
+
+        data = None
+        if request.get('dataLength'):
+            data = stream.read(request['dataLength'])
+            if len(data) != request['dataLength']:
+                return {'ok': False, 'error': 'image data ended early'}
+            if not request.get('output'):
+                return {'ok': False, 'error': 'no output for image data'}
+        elif not request.get('image'):
+            return {'ok': False, 'error': 'no image'}
+        if not request.get('output'):
+            return {'ok': False, 'error': 'no output'}
+        try:
+            request['output'] = outputPath(self.directory, request['output'])
+        except SliceDaemonError as e:
+            return {'ok': False, 'error': str(e)}
+
+        try:
+            with self.outputLock(request['output']):
+                canceled, seconds = self.run(request, data, handler)
+        except Exception as e:
+            return {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+        if canceled:
+            return {'ok': False, 'canceled': True, 'error': 'canceled'}
+        with self.lock:
+            self.jobs += 1
+        return {'ok': True, 'output': request['output'], 'seconds': seconds}
+
+    def run(self, request, data, handler):
+        # Slices, passing the progress on to the client, until the slice is
+        # done or the client cancels it or goes away. Returns whether it was
+        # canceled and the seconds it took.
+        if self.executor:
+            progress = self.manager.Queue()
+            cancel = self.manager.Event()
+            job = self.executor.submit(sliceJob, request, data, progress, cancel)
+        else:
+            progress = queue.Queue()
+            cancel = threading.Event()
+            job = ThreadJob(sliceJob, request, data, progress, cancel)
+
+        connected = True
+        while True:
+            done = job.done()
+            try:
+                while connected:
+                    message = {'progress': list(progress.get_nowait())}
+                    writeLine(handler.wfile, message)
+            except queue.Empty:
+                pass
+            except socket.error:
+                connected = False
+                cancel.set()
+            if done:
+                break
+
+            readable = select.select([handler.connection], [], [], 0.1)[0]
+            if readable and connected:
+                try:
+                    message = readLine(handler.rfile)
+                except (ValueError, socket.error):
+                    message = None
+                if message is None:
+                    connected = False
+                if message is None or message.get('command') == 'cancel':
+                    cancel.set()
+
+        return (cancel.is_set(), job.result())
+
+'''
+A connection to a daemon, jobs are sent one after another over it.
+'''
+class SliceClient:
+    def __init__(self, address=None, timeout=None):
+        self.socket = connect(address, timeout)
+        self.stream = self.socket.makefile('rwb')
+
+    def close(self):
+        self.stream.close()
+        self.socket.close()
+
+    def request(self, message, data=None, progressFunc=None):
+        # Sends message and returns the response. progressFunc is called with
+        # the progress of a slice, the slice is canceled if it returns False.
+        if data is not None:
+            message['dataLength'] = len(data)
+        self.stream.write((json.dumps(message) + '\n').encode('utf-8'))
+        if data is not None:
+            self.stream.write(data)
+        self.stream.flush()
+        canceled = False
+        while True:
+            response = readLine(self.stream)
+            if response is None:
+                raise SliceDaemonError('the daemon closed the connection')
+            if 'progress' not in response:
+                break
+            if progressFunc and not canceled:
+                if not progressFunc(*response['progress']):
+                    canceled = True
+                    writeLine(self.stream, {'command': 'cancel'})
+        if response.get('canceled'):
+            return response
+        if not response.get('ok'):
+            raise SliceDaemonError(response.get('error'))
+        return response
+
+    def slice(self, image, output, options=None, size=None, progressFunc=None):
+        # Slices the image file at path image to output, in the daemon's
+        # output directory, returns the hex file path or None if canceled.
+        return self.request({'image': os.path.abspath(image), 'output': output,
+                             'options': options or {}, 'size': size},
+                            None, progressFunc).get('output')
+
+    def slicePixels(self, mode, width, height, data, output, options=None,
+                    progressFunc=None):
+        # Slices an image sent as its raw pixels, returns the hex file path or
+        # None if canceled.
+        return self.request({'data': {'mode': mode, 'width': width, 'height': height},
+                             'output': output, 'options': options or {}},
+                            data, progressFunc).get('output')
+
+    def ping(self):
+        return self.request({'command': 'ping'})
+
+    def stop(self):
+        return self.request({'command': 'stop'})
+
+USAGE = '''usage: slicedaemon serve [-a address] [-w workers] [-d output directory]
+       slicedaemon slice [-a address] <image file> <hex file> [option=value ...]
+       slicedaemon ping|stop [-a address]
+The address is the path of the socket, or on Windows a port.'''
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    address = None
+    workers = None
+    directory = None
+    try:
+        command = args.pop(0)
+        if '-a' in args:
+            i = args.index('-a')
+            address = args[i + 1]
+            del args[i:i + 2]
+        if '-w' in args:
+            i = args.index('-w')
+            workers = int(args[i + 1])
+            del args[i:i + 2]
+        if '-d' in args:
+            i = args.index('-d')
+            directory = args[i + 1]
+            del args[i:i + 2]
+        parseAddress(address)
+        if command not in ('serve', 'slice', 'ping', 'stop'):
+            raise ValueError()
+        if command == 'slice':
+            image = args.pop(0)
+            output = os.path.abspath(args.pop(0))
+            from imageproc import parseOptions
+            options = parseOptions(args)
+        elif args:
+            raise ValueError()
+    except (IndexError, ValueError):
+        print(USAGE)
+        sys.exit(1)
+
+    if command == 'serve':
+        daemon = SliceDaemon(address, workers, directory)
+        print('Slicing on {} with {} workers, to {}.'.format(daemon.address(), daemon.workers, daemon.directory))
+        daemon.serve()
+        sys.exit(0)
+
+    try:
+        client = SliceClient(address)
+        if command == 'slice':
+            print(client.slice(image, output, options))
+        elif command == 'ping':
+            response = client.ping()
+            print('{} workers, {} jobs done.'.format(response['workers'], response['jobs']))
+        else:
+            client.stop()
+        client.close()
+    except (socket.error, SliceDaemonError) as e:
+        print('slicedaemon: {}'.format(e))
+        sys.exit(1)
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Argentum Control GUI
+
+    Copyright (C) 2013 Isabella Stevens
+    Copyright (C) 2014 Michael Shiel
+    Copyright (C) 2015 Trent Waddington
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import hashlib
+
+from hexcompress import compressedPath
+
+def indexPath(path):
+    # Where the slicer writes the index of the hex file at path.
+    return path + 'i'
+
+# Changed whenever what is in the index changes, older indexes are ignored.
+INDEX_VERSION = 2
+
+def passDigest(bands, start):
+    # A digest of a pass from the digest of the rows of the planes it reads,
+    # from ImageProcessor.passBands, and start, the line feed held back and Y
+    # position the head starts it from. The commands of a pass only depend
+    # on these and the slice parameters.
+    digest = hashlib.sha1()
+    digest.update(bands.encode('utf-8'))
+    digest.update(repr(tuple(start)).encode('utf-8'))
+    return digest.hexdigest()
+
+'''
+The index of a hex file lists, for each pass, the digest of what the pass was
+made from, how many bytes of the hex file and of its compressed file it takes,
+the state the compressor was in before it and the line feed held back and Y
+position the head was left at after it. It is written next to the hex
+file as JSON once the slice is done.
+'''
+class SliceIndex:
+    def __init__(self, parameters):
+        self.parameters = list(parameters)
+        self.passes = []
+        self.finalState = None
+
+    def add(self, digest, length, compressedLength=None, state=None, end=None):
+        self.passes.append([digest, length, compressedLength, state, list(end or (0, 0))])
+
+    def save(self, path, compressed):
+        # Call once the hex file at path and the compressed file, if
+        # compressed, have been written.
+        index = {
+            'version': INDEX_VERSION,
+            'parameters': self.parameters,
+            'size': os.path.getsize(path),
+            'compressedSize': None,
+            'passes': self.passes,
+            'finalState': self.finalState,
+        }
+        if compressed:
+            index['compressedSize'] = os.path.getsize(compressedPath(path))
+        with open(indexPath(path), 'w') as f:
+            json.dump(index, f)
+
+'''
+The hex file, compressed file and index left by an earlier slice to the same
+path. They are moved out of the way, so the new slice can be written in their
+place and copy the passes that didn't change from them.
+'''
+class PreviousSlice:
+    def __init__(self, path, index):
+        self.passes = index['passes']
+        self.finalState = index['finalState']
+        self.reused = 0
+
+        self.path = path + '.previous'
+        os.rename(path, self.path)
+        self.file = open(self.path, 'rb')
+        self.offsets = [0]
+        for digest, length, compressedLength, state, end in self.passes:
+            self.offsets.append(self.offsets[-1] + length)
+
+        self.compressedFile = None
+        if index['compressedSize'] != None:
+            os.rename(compressedPath(path), compressedPath(self.path))
+            self.compressedFile = open(compressedPath(self.path), 'rb')
+            self.compressedOffsets = [0]
+            for digest, length, compressedLength, state, end in self.passes:
+                self.compressedOffsets.append(self.compressedOffsets[-1] + compressedLength)
+
+    @classmethod
+    def load(cls, path, parameters):
+        # Returns the previous slice at path, if there is one made with the
+        # same parameters, otherwise None.
+        try:
+            with open(indexPath(path), 'r') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        finally:
+            if os.path.exists(indexPath(path)):
+                os.remove(indexPath(path))
+
+        if index.get('version') != INDEX_VERSION:
+            return None
+        if index['parameters'] != json.loads(json.dumps(list(parameters))):
+            return None
+        if not os.path.exists(path) or os.path.getsize(path) != index['size']:
+            return None
+        if index['compressedSize'] != None:
+            if (not os.path.exists(compressedPath(path)) or
+                    os.path.getsize(compressedPath(path)) != index['compressedSize']):
+                index['compressedSize'] = None
+
+        for name in (path + '.previous', compressedPath(path + '.previous')):
+            if os.path.exists(name):
+                os.remove(name)
+        return cls(path, index)
+
+    def matches(self, y, digest):
+        return y < len(self.passes) and self.passes[y][0] == digest
+
+    def block(self, y):
+        # The commands of pass y.
+        self.reused += 1
+        self.file.seek(self.offsets[y])
+        return self.file.read(self.offsets[y + 1] - self.offsets[y])
+
+    def compressedLines(self, y, state):
+        # The compressed lines of pass y, if it was compressed starting from
+        # state, otherwise None.
+        if not self.compressedFile or self.passes[y][3] != state:
+            return None
+        self.compressedFile.seek(self.compressedOffsets[y])
+        text = self.compressedFile.read(self.compressedOffsets[y + 1] - self.compressedOffsets[y])
+        return text.decode('utf-8').split('\n')[:-1]
+
+    def endPosition(self, y):
+        # The line feed held back and Y position of the head after pass y.
+        return tuple(self.passes[y][4])
+
+    def endState(self, y):
+        # The compressor state after pass y.
+        if y + 1 < len(self.passes):
+            return self.passes[y + 1][3]
+        return self.finalState
+
+    def close(self):
+        self.file.close()
+        os.remove(self.path)
+        if self.compressedFile:
+            self.compressedFile.close()
+            os.remove(compressedPath(self.path))